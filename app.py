@@ -1,17 +1,40 @@
 """
 股票追蹤 Web 應用 - Flask 主程式
 """
+import json
 import logging
-from flask import Flask, render_template, request, jsonify
+import os
+import threading
+import time
+
+# STARTUP_PROFILE=1 時回報 worker 載入本模組的耗時與記憶體 (見 startup_profile.py)
+_import_started = time.perf_counter()
+
+from functools import wraps
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
 from models import (
-    init_db, get_config, update_config,
-    create_batch, get_all_batches, get_batch, update_batch, delete_batch,
+    init_db, release_db, get_config, update_config,
+    create_batch, get_batch, update_batch, delete_batch,
     add_stock_record, get_stocks_by_batch, update_stock_record,
-    update_stock_current_price, delete_stock_record, get_all_stock_records,
-    sell_stock, unsell_stock, move_stock_to_batch
+    update_stock_current_prices, delete_stock_record, get_open_stock_records, get_open_stock_prices,
+    sell_stock, unsell_stock, move_stock_to_batch, get_refresh_job,
+    get_batch_summaries, get_batch_summary_page, get_portfolio_totals,
+    save_batch_full, get_data_version, get_changes,
+    get_records_with_buy_date, get_close_history
+)
+from fees import (
+    STANDARD_FEE_RATE, FEE_DISCOUNT,
+    calc_stock_fees_records
 )
-from stock_service import get_stock_name, get_stock_price, get_stock_info
-from datetime import datetime
+from stock_service import (
+    get_stock_name, get_stock_names, get_stock_prices, get_stock_prices_within, get_stock_info,
+    get_quote_stats
+)
+from stock_index import search as search_stocks, SEARCH_LIMIT, SEARCH_LIMIT_MAX
+from price_refresher import submit_refresh_job, submit_history_backfill, start_scheduler
+from calculator import allocate_equal, odd_lot_shares, optimize_shares, DEFAULT_TOLERANCE
+import startup_profile
+from datetime import datetime, timezone
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,6 +44,11 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+# 即時股價推播：輪詢資料庫間隔、心跳間隔與單一連線最長維持時間 (秒)
+STREAM_POLL_INTERVAL = float(os.environ.get("STREAM_POLL_INTERVAL", 3))
+STREAM_HEARTBEAT = 15
+STREAM_MAX_SECONDS = float(os.environ.get("STREAM_MAX_SECONDS", 600))
+
 @app.before_request
 def log_request_info():
     logger.info(f"Received request: {request.method} {request.url}")
@@ -30,11 +58,60 @@ def log_response_info(response):
     logger.info(f"Response: {response.status}")
     return response
 
+@app.teardown_appcontext
+def release_db_connection(exc):
+    """請求結束時把資料庫連線歸還連線池"""
+    release_db(exc)
+
 @app.errorhandler(Exception)
 def handle_exception(e):
     logger.error(f"Server error: {e}", exc_info=True)
     return jsonify({"error": "內部伺服器錯誤", "details": str(e)}), 500
 
+# 依資料版本快取的回應內容：{請求路徑: (版本, 內容, mimetype, 自訂標頭)}，只保留最新版本
+_response_cache = {}
+_response_cache_lock = threading.Lock()
+
+
+def versioned(view):
+    """
+    讓 GET API 依資料版本做條件式回應：
+    回應帶 ETag / Last-Modified，用戶端的 If-None-Match 仍是目前版本時
+    直接回 304，不查詢也不計算；版本未變時重複使用已序列化的 JSON
+    只依 ETag 判斷：Last-Modified 只到秒，同一秒內的兩次寫入無法以 If-Modified-Since 區分
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        version, updated_at = get_data_version()
+        etag = f"v{version}"
+        last_modified = datetime.fromtimestamp(int(updated_at), timezone.utc)
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            key = request.full_path
+            with _response_cache_lock:
+                cached = _response_cache.get(key)
+            if cached is None or cached[0] != version:
+                rendered = app.make_response(view(*args, **kwargs))
+                if rendered.status_code != 200:
+                    return rendered
+                extra_headers = [(k, v) for k, v in rendered.headers if k.startswith("X-")]
+                cached = (version, rendered.get_data(), rendered.mimetype, extra_headers)
+                with _response_cache_lock:
+                    for stale in [k for k, v in _response_cache.items() if v[0] < version]:
+                        del _response_cache[stale]
+                    _response_cache[key] = cached
+            response = Response(cached[1], mimetype=cached[2], headers=cached[3])
+
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        # 每次都要向伺服器確認版本，但可沿用瀏覽器快取的內容
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+    return wrapper
+
+
 @app.route("/api/health")
 def health_check():
     return jsonify({"status": "ok", "time": datetime.now().isoformat()})
@@ -46,51 +123,10 @@ try:
 except Exception as e:
     logger.error(f"資料庫初始化失敗: {e}")
 
-# 台股手續費標準費率
-STANDARD_FEE_RATE = 0.001425  # 0.1425%
-# 證交稅稅率
-SECURITIES_TAX_RATE = 0.003    # 0.3%
-# 手續費折讓 (固定 2.8 折)
-FEE_DISCOUNT = 0.28
-
-
-def calc_fees(buy_price, shares, price_for_sell, fee_discount, is_carry_over_buy=False, is_carry_over_sell=False):
-    """
-    計算單檔股票的交易成本
-    price_for_sell: 已賣出時傳入 sell_price，未賣出傳入 current_price
-    """
-    buy_amount = buy_price * shares
-    sell_amount = (price_for_sell or 0) * shares
-
-    buy_fee = 0 if is_carry_over_buy else int(buy_amount * STANDARD_FEE_RATE * fee_discount)  # 無條件捨去
-    sell_fee = 0 if is_carry_over_sell else int(sell_amount * STANDARD_FEE_RATE * fee_discount)
-    sell_tax = 0 if is_carry_over_sell else int(sell_amount * SECURITIES_TAX_RATE)
-
-    total_cost = buy_amount + buy_fee
-    net_value = sell_amount - sell_fee - sell_tax
-    net_pnl = net_value - total_cost
-    net_pnl_pct = ((net_value / total_cost - 1) * 100) if total_cost > 0 else 0
-
-    return {
-        "buy_amount": buy_amount,
-        "buy_fee": buy_fee,
-        "sell_amount": sell_amount,
-        "sell_fee": sell_fee,
-        "sell_tax": sell_tax,
-        "total_fees": buy_fee + sell_fee + sell_tax,
-        "total_cost": total_cost,
-        "net_value": net_value,
-        "net_pnl": net_pnl,
-        "net_pnl_pct": net_pnl_pct
-    }
-
-
-def get_effective_sell_price(stock):
-    """取得用於計算的賣出價：已賣出用 sell_price，否則用 current_price"""
-    if stock.get("is_sold"):
-        return stock.get("sell_price", 0)
-    return stock.get("current_price", 0)
+# 啟動背景定時股價更新
+start_scheduler()
 
+startup_profile.report("載入 app", _import_started)
 
 # ============ 頁面路由 ============
 
@@ -104,6 +140,7 @@ def index():
 # ============ Config API ============
 
 @app.route("/api/config", methods=["GET"])
+@versioned
 def api_get_config():
     config = get_config()
     return jsonify(config)
@@ -120,32 +157,79 @@ def api_update_config():
 
 # ============ Batch API ============
 
+BATCH_PAGE_MAX = 200
+
+
+def _batch_list_args():
+    """
+    解析批次列表的分頁與篩選參數：limit, cursor, status (open / closed), from, to, code
+    未帶 limit 時回傳全部批次 (與舊版相容)；參數不合法時拋出 ValueError
+    """
+    limit = request.args.get("limit")
+    if limit is not None:
+        limit = int(limit)
+        if not 1 <= limit <= BATCH_PAGE_MAX:
+            raise ValueError(f"limit 需介於 1 到 {BATCH_PAGE_MAX}")
+
+    after = None
+    cursor = request.args.get("cursor")
+    if cursor:
+        start_date, _, batch_id = cursor.rpartition(",")
+        after = (start_date, int(batch_id))
+
+    status = request.args.get("status") or None
+    if status not in (None, "open", "closed"):
+        raise ValueError("status 只能是 open 或 closed")
+
+    filters = {
+        "status": status,
+        "date_from": request.args.get("from") or None,
+        "date_to": request.args.get("to") or None,
+        "stock_code": request.args.get("code", "").strip() or None
+    }
+    return limit, after, filters
+
+
+def _query_batches():
+    """依請求參數讀取批次彙總，回傳 (批次列表, 下一頁游標字串)"""
+    limit, after, filters = _batch_list_args()
+    if limit is None:
+        return get_batch_summaries(after=after, **filters), None
+    batches, next_after = get_batch_summary_page(limit, after, **filters)
+    return batches, (f"{next_after[0]},{next_after[1]}" if next_after else None)
+
+
 @app.route("/api/batches", methods=["GET"])
+@versioned
 def api_get_batches():
-    batches = get_all_batches()
-    # 為每個批次附帶股票紀錄摘要
-    for batch in batches:
-        stocks = get_stocks_by_batch(batch["id"])
-        batch_total_cost = 0
-        batch_net_value = 0
-        batch_total_fees = 0
-        for s in stocks:
-            price = get_effective_sell_price(s)
-            fees = calc_fees(
-                s["buy_price"], s["shares"], price, FEE_DISCOUNT,
-                s.get("is_carry_over_buy", 0) == 1,
-                s.get("is_carry_over_sell", 0) == 1
-            )
-            batch_total_cost += fees["total_cost"]
-            batch_net_value += fees["net_value"]
-            batch_total_fees += fees["total_fees"]
-        batch["stock_count"] = len(stocks)
-        batch["total_cost"] = batch_total_cost
-        batch["total_market_value"] = batch_net_value
-        batch["total_fees"] = batch_total_fees
-        batch["total_pnl"] = batch_net_value - batch_total_cost
-        batch["total_pnl_pct"] = ((batch_net_value / batch_total_cost - 1) * 100) if batch_total_cost > 0 else 0
-    return jsonify(batches)
+    """批次列表，支援 keyset 分頁 (下一頁游標放在 X-Next-Cursor 標頭) 與篩選"""
+    try:
+        summaries, next_cursor = _query_batches()
+    except ValueError as e:
+        return jsonify({"error": f"參數錯誤: {e}"}), 400
+
+    batches = []
+    # 直接讀取物化的批次彙總
+    for batch in summaries:
+        batch_total_cost = batch["total_cost"]
+        batch_net_value = batch["net_value"]
+        batches.append({
+            "id": batch["id"],
+            "name": batch["name"],
+            "start_date": batch["start_date"],
+            "allocated_capital": batch["allocated_capital"],
+            "created_at": batch["created_at"],
+            "stock_count": batch["stock_count"],
+            "total_cost": batch_total_cost,
+            "total_market_value": batch_net_value,
+            "total_fees": batch["total_fees"],
+            "total_pnl": batch_net_value - batch_total_cost,
+            "total_pnl_pct": ((batch_net_value / batch_total_cost - 1) * 100) if batch_total_cost > 0 else 0
+        })
+    response = jsonify(batches)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
 
 
 @app.route("/api/batches", methods=["POST"])
@@ -159,19 +243,14 @@ def api_create_batch():
 
 
 @app.route("/api/batches/<int:batch_id>", methods=["GET"])
+@versioned
 def api_get_batch(batch_id):
     batch = get_batch(batch_id)
     if not batch:
         return jsonify({"error": "批次不存在"}), 404
     stocks = get_stocks_by_batch(batch_id)
-    # 為每檔股票附加費用計算
-    for s in stocks:
-        price = get_effective_sell_price(s)
-        fees = calc_fees(
-            s["buy_price"], s["shares"], price, FEE_DISCOUNT,
-            s.get("is_carry_over_buy", 0) == 1,
-            s.get("is_carry_over_sell", 0) == 1
-        )
+    # 為每檔股票附加費用計算 (整欄一次計算)
+    for s, fees in zip(stocks, calc_stock_fees_records(stocks, FEE_DISCOUNT)):
         s.update(fees)
     batch["stocks"] = stocks
     return jsonify(batch)
@@ -193,6 +272,53 @@ def api_delete_batch(batch_id):
     return jsonify({"success": True})
 
 
+def _save_batch_full(batch_id):
+    """解析整批儲存的請求內容，名稱缺漏的代碼一次批次查詢後寫入"""
+    data = request.get_json()
+    name = data.get("name", "")
+    start_date = data.get("start_date", datetime.now().strftime("%Y-%m-%d"))
+    allocated_capital = float(data.get("allocated_capital", 0))
+
+    stocks = []
+    for row in data.get("stocks", []):
+        stock_code = str(row.get("stock_code", "")).strip()
+        if not stock_code:
+            continue
+        record_id = row.get("record_id")
+        stocks.append({
+            "record_id": int(record_id) if record_id else None,
+            "stock_code": stock_code,
+            "stock_name": row.get("stock_name", ""),
+            "buy_price": float(row.get("buy_price", 0)),
+            "shares": int(row.get("shares", 0))
+        })
+
+    # 如果沒提供名稱，自動查詢
+    missing = [s["stock_code"] for s in stocks if not s["record_id"] and not s["stock_name"]]
+    if missing:
+        names = get_stock_names(missing)
+        for s in stocks:
+            if not s["record_id"] and not s["stock_name"]:
+                s["stock_name"] = names[s["stock_code"]]
+
+    batch_id = save_batch_full(batch_id, name, start_date, allocated_capital, stocks)
+    if batch_id is None:
+        return jsonify({"error": "批次不存在"}), 404
+    return jsonify({"success": True, "batch_id": batch_id})
+
+
+@app.route("/api/batches/full", methods=["POST"])
+def api_create_batch_full():
+    """以單一交易建立批次與所有股票紀錄"""
+    return _save_batch_full(None)
+
+
+@app.route("/api/batches/<int:batch_id>/full", methods=["PUT"])
+def api_update_batch_full(batch_id):
+    """以單一交易更新批次表頭並儲存所有股票紀錄"""
+    return _save_batch_full(batch_id)
+
+
 # ============ Stock Record API ============
 
 @app.route("/api/batches/<int:batch_id>/stocks", methods=["POST"])
@@ -267,67 +393,115 @@ def api_stock_info(stock_code):
     return jsonify(info)
 
 
+@app.route("/api/stocks/search", methods=["GET"])
+def api_search_stocks():
+    """以代碼前綴或中文名稱子字串搜尋股票 (輸入自動完成用，只查本機索引、不抓股價)"""
+    query = request.args.get("q", "")
+    try:
+        limit = int(request.args.get("limit", SEARCH_LIMIT))
+    except ValueError:
+        return jsonify({"error": "limit 必須是整數"}), 400
+    limit = max(1, min(limit, SEARCH_LIMIT_MAX))
+    return jsonify({"query": query, "results": search_stocks(query, limit)})
+
+
+@app.route("/api/quote-stats", methods=["GET"])
+def api_quote_stats():
+    """報價快取命中與合併抓取的統計 (僅限處理此請求的 worker)"""
+    return jsonify(get_quote_stats())
+
+
 @app.route("/api/refresh-prices/<int:batch_id>", methods=["POST"])
 def api_refresh_prices(batch_id):
     """更新某批次所有未賣出股票的最新股價"""
-    stocks = get_stocks_by_batch(batch_id)
+    stocks = get_open_stock_records(batch_id)
+    prices = get_stock_prices([s["stock_code"] for s in stocks])
+    updates = {}
     updated = []
     for stock in stocks:
-        if stock.get("is_sold"):
-            continue
-        price, success = get_stock_price(stock["stock_code"])
+        price, success = prices[stock["stock_code"]]
         if success:
-            update_stock_current_price(stock["id"], price)
+            updates[stock["id"]] = price
             updated.append({
                 "id": stock["id"],
                 "stock_code": stock["stock_code"],
                 "current_price": price
             })
+    update_stock_current_prices(updates)
     return jsonify({"success": True, "updated": updated})
 
 
 @app.route("/api/refresh-all-prices", methods=["POST"])
 def api_refresh_all_prices():
     """更新所有批次中未賣出股票的最新股價"""
-    batches = get_all_batches()
-    total_updated = 0
-    for batch in batches:
-        stocks = get_stocks_by_batch(batch["id"])
-        for stock in stocks:
-            if stock.get("is_sold"):
-                continue
-            price, success = get_stock_price(stock["stock_code"])
-            if success:
-                update_stock_current_price(stock["id"], price)
-                total_updated += 1
+    stocks = get_open_stock_records()
+    prices = get_stock_prices([s["stock_code"] for s in stocks])
+    total_updated = update_stock_current_prices(
+        {code: price for code, (price, success) in prices.items() if success},
+        key="stock_code"
+    )
     return jsonify({"success": True, "total_updated": total_updated})
 
 
+@app.route("/api/refresh-jobs", methods=["POST"])
+def api_create_refresh_job():
+    """排入背景股價更新工作，可用 batch_id 限定單一批次"""
+    data = request.get_json(silent=True) or {}
+    batch_id = data.get("batch_id")
+    job_id = submit_refresh_job(int(batch_id) if batch_id else None)
+    return jsonify({"success": True, "job_id": job_id}), 202
+
+
+@app.route("/api/refresh-jobs/<int:job_id>", methods=["GET"])
+def api_get_refresh_job(job_id):
+    """查詢背景股價更新工作的進度與結果"""
+    job = get_refresh_job(job_id)
+    if not job:
+        return jsonify({"error": "工作不存在"}), 404
+    return jsonify(job)
+
+
 # ============ 試算 API ============
 
 @app.route("/api/calculate", methods=["POST"])
 def api_calculate():
-    """每週零股試算：給定預算和股票清單，平均分配試算"""
+    """
+    每週零股試算：給定預算和股票清單試算各檔股數
+    mode="equal" (預設) 平均分配後無條件捨去；mode="optimize" 在 tolerance 範圍內盡量用完預算 (含手續費)
+    """
     data = request.get_json()
     budget = float(data.get("budget", 0))
     stock_codes = data.get("stocks", [])
+    mode = data.get("mode", "equal")
+    tolerance = float(data.get("tolerance", DEFAULT_TOLERANCE))
 
     if budget <= 0 or not stock_codes:
         return jsonify({"error": "請輸入預算和至少一檔股票"}), 400
+    if mode not in ("equal", "optimize"):
+        return jsonify({"error": "mode 只能是 equal 或 optimize"}), 400
+    if tolerance < 0:
+        return jsonify({"error": "tolerance 不可為負數"}), 400
 
     num_stocks = len(stock_codes)
-    allocated = budget / num_stocks
+    allocated = allocate_equal(budget, num_stocks)
     results = []
     total_cost = 0
-
-    for code in stock_codes:
-        code = str(code).strip()
-        if not code:
-            continue
-        name = get_stock_name(code)
-        price, success = get_stock_price(code)
+    # 平行抓價並設定整體期限，逾時的代碼視為抓取失敗
+    prices, waited, timed_out = get_stock_prices_within(stock_codes)
+    names = get_stock_names(stock_codes)
+
+    codes = [str(code).strip() for code in stock_codes]
+    codes = [code for code in codes if code]
+    buy_prices = [prices[code][0] if prices[code][1] else 0 for code in codes]
+    if mode == "optimize":
+        share_counts = optimize_shares(budget, buy_prices, tolerance)
+    else:
+        share_counts = odd_lot_shares(allocated, buy_prices)
+
+    for code, price, shares in zip(codes, buy_prices, share_counts.tolist()):
+        name = names[code]
+        success = prices[code][1]
         if success and price > 0:
-            shares = int(allocated // price)
             cost = shares * price
             buy_fee = int(cost * STANDARD_FEE_RATE * FEE_DISCOUNT)
             total_with_fee = cost + buy_fee
@@ -341,7 +515,8 @@ def api_calculate():
         results.append({
             "stock_code": code,
             "stock_name": name,
-            "price": price if success else 0,
+            "price": price,
+            "success": success,
             "shares": shares,
             "cost": cost,
             "buy_fee": buy_fee,
@@ -350,133 +525,249 @@ def api_calculate():
 
     return jsonify({
         "budget": budget,
+        "mode": mode,
+        "tolerance": tolerance if mode == "optimize" else None,
         "allocated_per_stock": allocated,
         "num_stocks": num_stocks,
         "results": results,
         "total_cost": total_cost,
-        "remaining": budget - total_cost
+        "remaining": budget - total_cost,
+        "quote_wait_ms": round(waited * 1000),
+        "timed_out": timed_out
     })
 
 
 # ============ 統計 API ============
 
-@app.route("/api/summary", methods=["GET"])
-def api_summary():
-    """取得整體統計摘要"""
-    batches = get_all_batches()
-
-    total_cost = 0
-    total_net_value = 0
-    total_fees = 0
-    total_realized_pnl = 0
-    total_unrealized_pnl = 0
-
-    batch_summaries = []
-    for batch in batches:
-        stocks = get_stocks_by_batch(batch["id"])
-        batch_cost = 0
-        batch_net = 0
-        batch_fees = 0
-        batch_realized = 0
-        batch_unrealized = 0
-        
-        is_closed = (len(stocks) > 0) and all(s.get("is_sold") for s in stocks)
-        win_count = 0
-        loss_count = 0
-        best_stock = None
-        worst_stock = None
+def _summary_batch_entry(batch):
+    """把物化的批次彙總轉成摘要 API 的批次格式"""
+    batch_cost = batch["total_cost"]
+    batch_net = batch["net_value"]
+    return {
+        "id": batch["id"],
+        "name": batch["name"],
+        "start_date": batch["start_date"],
+        "total_cost": batch_cost,
+        "total_market_value": batch_net,
+        "total_fees": batch["total_fees"],
+        "pnl": batch_net - batch_cost,
+        "pnl_pct": ((batch_net / batch_cost - 1) * 100) if batch_cost > 0 else 0,
+        "realized_pnl": batch["realized_pnl"],
+        "unrealized_pnl": batch["unrealized_pnl"],
+        "stock_count": batch["stock_count"],
+        "is_closed": batch["is_closed"],
+        "win_count": batch["win_count"],
+        "loss_count": batch["loss_count"],
+        "best_stock": batch["best_stock"],
+        "worst_stock": batch["worst_stock"]
+    }
 
-        for s in stocks:
-            price = get_effective_sell_price(s)
-            fees = calc_fees(
-                s["buy_price"], s["shares"], price, FEE_DISCOUNT,
-                s.get("is_carry_over_buy", 0) == 1,
-                s.get("is_carry_over_sell", 0) == 1
-            )
-            batch_cost += fees["total_cost"]
-            batch_net += fees["net_value"]
-            batch_fees += fees["total_fees"]
-            
-            pnl = fees["net_pnl"]
-            stock_cost = fees["total_cost"]
-            stock_pnl_pct = (pnl / stock_cost * 100) if stock_cost > 0 else 0
-            
-            # 計算勝敗
-            if pnl > 0:
-                win_count += 1
-            elif pnl < 0:
-                loss_count += 1
-                
-            # 計算最佳與最差
-            if best_stock is None or stock_pnl_pct > best_stock["pnl_pct"]:
-                best_stock = {
-                    "stock_code": s["stock_code"],
-                    "stock_name": s["stock_name"],
-                    "pnl": pnl,
-                    "pnl_pct": stock_pnl_pct
-                }
-                
-            if worst_stock is None or stock_pnl_pct < worst_stock["pnl_pct"]:
-                worst_stock = {
-                    "stock_code": s["stock_code"],
-                    "stock_name": s["stock_name"],
-                    "pnl": pnl,
-                    "pnl_pct": stock_pnl_pct
-                }
-            
-            if s.get("is_sold"):
-                batch_realized += pnl
-            else:
-                batch_unrealized += pnl
-
-        batch_pnl = batch_net - batch_cost
-        batch_pnl_pct = ((batch_net / batch_cost - 1) * 100) if batch_cost > 0 else 0
-
-        total_cost += batch_cost
-        total_net_value += batch_net
-        total_fees += batch_fees
-        total_realized_pnl += batch_realized
-        total_unrealized_pnl += batch_unrealized
-        
-        # 只在已結算或者至少有股票的狀態下回傳最佳/最差
-        if len(stocks) == 0:
-            best_stock = None
-            worst_stock = None
-
-        batch_summaries.append({
-            "id": batch["id"],
-            "name": batch["name"],
-            "start_date": batch["start_date"],
-            "total_cost": batch_cost,
-            "total_market_value": batch_net,
-            "total_fees": batch_fees,
-            "pnl": batch_pnl,
-            "pnl_pct": batch_pnl_pct,
-            "realized_pnl": batch_realized,
-            "unrealized_pnl": batch_unrealized,
-            "stock_count": len(stocks),
-            "is_closed": is_closed,
-            "win_count": win_count,
-            "loss_count": loss_count,
-            "best_stock": best_stock,
-            "worst_stock": worst_stock
-        })
 
+def _portfolio_totals():
+    """整體投入、市值、費用與損益 (由資料庫加總批次彙總)"""
+    totals = get_portfolio_totals()
+    total_cost = totals["total_cost"]
+    total_net_value = totals["net_value"]
     total_pnl = total_net_value - total_cost
     total_pnl_pct = ((total_net_value / total_cost - 1) * 100) if total_cost > 0 else 0
 
-    return jsonify({
+    return {
         "total_invested": total_cost,
         "total_market_value": total_net_value,
-        "total_fees": total_fees,
+        "total_fees": totals["total_fees"],
         "total_pnl": total_pnl,
         "total_pnl_pct": total_pnl_pct,
-        "realized_pnl": total_realized_pnl,
-        "unrealized_pnl": total_unrealized_pnl,
-        "batch_count": len(batches),
-        "batches": batch_summaries
+        "realized_pnl": totals["realized_pnl"],
+        "unrealized_pnl": totals["unrealized_pnl"],
+        "batch_count": totals["batch_count"]
+    }
+
+
+def _build_summary(batches, next_cursor=None):
+    """組出整體統計摘要 (讀取物化的批次彙總，不重新計算各檔費用)"""
+    summary = _portfolio_totals()
+    summary["batches"] = [_summary_batch_entry(b) for b in batches]
+    summary["next_cursor"] = next_cursor
+    return summary
+
+
+@app.route("/api/summary", methods=["GET"])
+@versioned
+def api_summary():
+    """取得整體統計摘要；批次部分支援與 /api/batches 相同的分頁與篩選參數，整體統計不受篩選影響"""
+    try:
+        batches, next_cursor = _query_batches()
+    except ValueError as e:
+        return jsonify({"error": f"參數錯誤: {e}"}), 400
+    return jsonify(_build_summary(batches, next_cursor))
+
+
+# ============ Price History / Equity Curve ============
+
+@app.route("/api/price-history/backfill", methods=["POST"])
+def api_backfill_price_history():
+    """
+    在背景補抓日線 (只抓尚未查詢過的日期)
+    預設為持有過的代碼；可帶 codes 與 start (例如回測用的候選股票) 指定代碼與起始日
+    """
+    data = request.get_json(silent=True) or {}
+    codes = [str(c).strip() for c in data.get("codes", []) if str(c).strip()]
+    targets = None
+    if codes:
+        start = data.get("start")
+        if not start:
+            return jsonify({"error": "指定代碼時需提供起始日 start"}), 400
+        targets = {code: (start, None) for code in codes}
+    started = submit_history_backfill(targets)
+    return jsonify({"success": True, "started": started}), 202
+
+
+@app.route("/api/equity-curve", methods=["GET"])
+@versioned
+def api_equity_curve():
+    """
+    投資組合權益曲線：每日投入成本、淨市值、累計淨損益與最大回撤，可用 batch_id 限定單一批次
+    以已儲存的日線計算，依資料版本快取
+    """
+    batch_id = request.args.get("batch_id", type=int)
+    if batch_id is not None and not get_batch(batch_id):
+        return jsonify({"error": "批次不存在"}), 404
+    stocks = get_records_with_buy_date(batch_id)
+    codes = sorted({s["stock_code"] for s in stocks})
+    start_date = min((s["buy_date"] for s in stocks), default=None)
+    # 依賴 numpy 的分析模組在第一次使用時才載入，不拖慢 worker 啟動
+    from equity import compute_equity_curve
+    return jsonify(compute_equity_curve(stocks, get_close_history(codes, start_date)))
+
+
+# ============ Backtest ============
+
+BACKTEST_MAX_BASKETS = 1000
+
+
+@app.route("/api/backtest", methods=["POST"])
+def api_backtest():
+    """
+    以已儲存的日線回測每週零股策略
+    body: {"baskets": [[代碼, ...], ...], "budget": 每週預算, "start": 起始日, "end": 結束日 (選填)}
+    """
+    data = request.get_json(silent=True) or {}
+    baskets = data.get("baskets") or []
+    budget = float(data.get("budget", 0))
+    start_date = data.get("start")
+    end_date = data.get("end")
+
+    if budget <= 0 or not baskets or not start_date:
+        return jsonify({"error": "請輸入預算、起始日和至少一組股票"}), 400
+    if len(baskets) > BACKTEST_MAX_BASKETS:
+        return jsonify({"error": f"一次最多回測 {BACKTEST_MAX_BASKETS} 組"}), 400
+    if any(not isinstance(b, list) or not b for b in baskets):
+        return jsonify({"error": "每組股票至少需要一檔代碼"}), 400
+
+    codes = sorted({str(c).strip() for b in baskets for c in b if str(c).strip()})
+    history = get_close_history(codes, start_date, end_date)
+    from backtest import run_weekly_backtest
+    result = run_weekly_backtest(baskets, history, budget)
+    result.update({"budget": budget, "start": start_date, "end": end_date})
+    return jsonify(result)
+
+
+# ============ Incremental Sync ============
+
+@app.route("/api/changes", methods=["GET"])
+def api_changes():
+    """
+    取得資料版本 since 之後異動的批次與股票紀錄、已刪除的 ID 以及最新的整體統計
+    since 缺漏或不合理時回傳 full=true，前端應改為重新載入完整摘要
+    """
+    version, _ = get_data_version()
+    since = request.args.get("since", type=int)
+    if since is None or since <= 0 or since > version:
+        return jsonify({"version": version, "full": True})
+
+    changes = get_changes(since)
+    stocks = changes["stocks"]
+    for s, fees in zip(stocks, calc_stock_fees_records(stocks, FEE_DISCOUNT)):
+        s.update(fees)
+    return jsonify({
+        "version": version,
+        "full": False,
+        "batches": [_summary_batch_entry(b) for b in changes["batches"]],
+        "stocks": stocks,
+        "deleted": {
+            "batches": changes["deleted_batches"],
+            "stocks": changes["deleted_stocks"]
+        },
+        "totals": _portfolio_totals()
     })
 
 
+# ============ Live Price Stream (SSE) ============
+
+def _price_deltas(record_ids):
+    """計算指定未賣出紀錄的最新現價與淨損益，以及受影響批次與整體的統計"""
+    stocks = [s for s in get_open_stock_records() if s["id"] in record_ids]
+    changes = []
+    for stock, fees in zip(stocks, calc_stock_fees_records(stocks)):
+        changes.append({
+            "record_id": stock["id"],
+            "batch_id": stock["batch_id"],
+            "stock_code": stock["stock_code"],
+            "current_price": stock["current_price"],
+            "net_pnl": fees["net_pnl"],
+            "net_pnl_pct": fees["net_pnl_pct"],
+            "total_fees": fees["total_fees"]
+        })
+
+    batch_ids = {c["batch_id"] for c in changes}
+    return {
+        "changes": changes,
+        "batches": [
+            {key: b[key] for key in ("id", "total_cost", "total_market_value", "total_fees", "pnl", "pnl_pct")}
+            for b in map(_summary_batch_entry, get_batch_summaries(batch_ids))
+        ],
+        "totals": _portfolio_totals(),
+        "price_updated_at": stocks[0]["price_updated_at"] if stocks else None
+    }
+
+
+@app.route("/api/stream/prices")
+def api_stream_prices():
+    """
+    Server-Sent Events：定時比對資料庫中未賣出紀錄的現價，有變動時推送差異
+    每次只讀 (id, current_price)，有變動才計算受影響紀錄的損益；
+    連線維持 STREAM_MAX_SECONDS 後由伺服器結束，瀏覽器的 EventSource 會自動重連
+    """
+    def generate():
+        prices = get_open_stock_prices()
+        release_db()
+        yield f"retry: {int(STREAM_POLL_INTERVAL * 1000)}\n\n"
+
+        started = last_sent = time.monotonic()
+        while time.monotonic() - started < STREAM_MAX_SECONDS:
+            time.sleep(STREAM_POLL_INTERVAL)
+            try:
+                latest = get_open_stock_prices()
+                changed = {rid for rid, price in latest.items() if rid in prices and prices[rid] != price}
+                prices = latest
+                if changed:
+                    payload = json.dumps(_price_deltas(changed), ensure_ascii=False)
+                    yield f"event: prices\ndata: {payload}\n\n"
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= STREAM_HEARTBEAT:
+                    # 註解行作為心跳，避免代理伺服器因閒置切斷連線
+                    yield ": ping\n\n"
+                    last_sent = time.monotonic()
+            finally:
+                # 等待期間不佔用連線池
+                release_db()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=5000)
@@ -0,0 +1,103 @@
+"""
+每週零股策略回測 - 以日線歷史重播「每週平均分配預算買進、下週賣出」的策略
+一次處理 週 × 籃子 × 檔 的矩陣，可同時回測大量候選股票組合
+"""
+import numpy as np
+from fees import FEE_DISCOUNT, calc_fees_columns
+from calculator import allocate_equal, odd_lot_shares
+from equity import close_matrix
+
+
+def _week_starts(dates):
+    """每個週一起算的交易週中第一個交易日的索引"""
+    # datetime64[W] 以 1970-01-01 (週四) 為週界，往後移 3 天讓每週從週一開始
+    weeks = (dates + np.timedelta64(3, "D")).astype("datetime64[W]")
+    _, first = np.unique(weeks, return_index=True)
+    return first
+
+
+def _basket_matrix(baskets, codes):
+    """把籃子清單轉成 籃子 × 檔 的代碼索引矩陣，不足的位置以 -1 補齊"""
+    code_index = {code: j for j, code in enumerate(codes)}
+    width = max(len(b) for b in baskets)
+    index = np.full((len(baskets), width), -1, dtype=np.int64)
+    for i, basket in enumerate(baskets):
+        index[i, :len(basket)] = [code_index[code] for code in basket]
+    return index
+
+
+def run_weekly_backtest(baskets, history, budget, fee_discount=FEE_DISCOUNT):
+    """
+    回測每週零股策略：每週第一個交易日以收盤價、依 calculator 的規則 (預算平均分配、
+    allocated // price) 買進籃子內各檔，於下一週第一個交易日以收盤價全數賣出；
+    手續費、證交稅與 calc_fees 相同。買進日或賣出日當天沒有成交 (停牌、下市、尚未上市) 的個股
+    當週不買，資金留作現金
+    baskets: [[code, ...], ...]；history: {code: (dates, closes)}；budget: 每週投入的預算
+    回傳: {"weeks": 每週買進日, "baskets": [{"codes", "weekly", "summary"}], "missing_codes"}
+    """
+    baskets = [list(dict.fromkeys(str(c).strip() for c in b if str(c).strip())) for b in baskets]
+    codes = sorted({code for basket in baskets for code in basket})
+    missing = [code for code in codes if code not in history]
+    # 不沿用前一日收盤價：當天沒有報價代表無法以該價格成交
+    dates, closes = close_matrix(history, codes, fill=False)
+
+    starts = _week_starts(dates) if len(dates) else np.array([], dtype=np.int64)
+    if len(starts) < 2 or not codes:
+        return {
+            "weeks": [],
+            "baskets": [{"codes": b, "weekly": None, "summary": None} for b in baskets],
+            "missing_codes": missing
+        }
+
+    entry_at, exit_at = starts[:-1], starts[1:]
+    index = _basket_matrix(baskets, codes)                    # B × K
+    in_basket = index >= 0
+    column = np.where(in_basket, index, 0)
+
+    # 週 × 籃子 × 檔
+    entry = closes[entry_at][:, column]
+    exit_ = closes[exit_at][:, column]
+    tradable = in_basket & ~np.isnan(entry) & ~np.isnan(exit_)
+    entry = np.where(tradable, entry, 0.0)
+    exit_ = np.where(tradable, exit_, 0.0)
+
+    sizes = in_basket.sum(axis=1)
+    allocated = np.array([allocate_equal(budget, n) for n in sizes])   # B
+    shares = odd_lot_shares(allocated[None, :, None], entry)
+
+    traded = calc_fees_columns(entry, shares, exit_, fee_discount, False, False)
+    bought = shares > 0
+    invested = np.where(bought, traded["total_cost"], 0.0).sum(axis=2)      # 週 × 籃子
+    proceeds = np.where(bought, traded["net_value"], 0.0).sum(axis=2)
+    fees = np.where(bought, traded["total_fees"], 0).sum(axis=2)
+    pnl = proceeds - invested
+    returns = pnl / budget * 100
+    cash_drag = (budget - invested) / budget * 100
+
+    compounded = (np.prod(1 + returns / 100, axis=0) - 1) * 100
+    results = []
+    for b, basket in enumerate(baskets):
+        results.append({
+            "codes": basket,
+            "weekly": {
+                "return_pct": returns[:, b].tolist(),
+                "cash_drag_pct": cash_drag[:, b].tolist(),
+                "fees": fees[:, b].tolist(),
+                "pnl": pnl[:, b].tolist()
+            },
+            "summary": {
+                "total_pnl": float(pnl[:, b].sum()),
+                "total_fees": int(fees[:, b].sum()),
+                "avg_return_pct": float(returns[:, b].mean()),
+                "compounded_return_pct": float(compounded[b]),
+                "avg_cash_drag_pct": float(cash_drag[:, b].mean()),
+                "win_weeks": int(np.count_nonzero(pnl[:, b] > 0)),
+                "loss_weeks": int(np.count_nonzero(pnl[:, b] < 0))
+            }
+        })
+
+    return {
+        "weeks": np.datetime_as_string(dates[entry_at]).tolist(),
+        "baskets": results,
+        "missing_codes": missing
+    }
@@ -0,0 +1,79 @@
+"""
+零股試算 - 預算平均分配後計算各檔可買的零股股數
+網頁試算 (/api/calculate)、命令列工具 (main.py) 與回測 (backtest.py) 共用同一套規則
+"""
+import heapq
+from fees import STANDARD_FEE_RATE, FEE_DISCOUNT
+
+# 最佳化模式下，每檔部位金額可偏離平均分配金額的比例
+DEFAULT_TOLERANCE = 0.1
+
+
+def allocate_equal(budget, num_stocks):
+    """預算平均分配給每一檔"""
+    return budget / num_stocks if num_stocks else 0.0
+
+
+def odd_lot_shares(allocated, prices):
+    """
+    依每檔分配金額計算可買零股數 (shares = allocated // price，無條件捨去)
+    allocated 與 prices 可為純量或可廣播的陣列；價格 <= 0 或 NaN 的位置股數為 0
+    回傳 int64 陣列 (純量輸入時為 0 維陣列)
+    """
+    # numpy 在第一次試算時才載入 (與 fees 相同)，不拖慢 worker 啟動
+    import numpy as np
+
+    prices = np.asarray(prices, dtype=np.float64)
+    valid = prices > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        shares = np.floor_divide(allocated, np.where(valid, prices, 1.0))
+    return np.where(valid, shares, 0).astype(np.int64)
+
+
+def buy_cost(price, shares, fee_discount=FEE_DISCOUNT):
+    """買進成本 (含無條件捨去的手續費，與 calc_fees 的 buy_fee 相同)"""
+    amount = price * shares
+    return amount + int(amount * STANDARD_FEE_RATE * fee_discount)
+
+
+def optimize_shares(budget, prices, tolerance=DEFAULT_TOLERANCE, fee_discount=FEE_DISCOUNT):
+    """
+    在「每檔部位金額不超過平均分配金額 (1 + tolerance) 倍」的限制下，
+    盡量用完預算 (含買進手續費) 的零股股數
+    1. 先以扣除手續費後的平均分配金額無條件捨去，得到不超過預算的起始解
+    2. 再以最小堆積反覆替「加一股後權重最低」的個股加一股，加了會超出預算或上限就不再考慮該檔
+       (剩餘預算只會減少，放不進的那一股之後也放不進)
+    只有價格 > 0 的個股參與分配；每檔最多被加股到上限，運算量與剩餘預算可買的股數成正比
+    回傳 int64 陣列，與 prices 同順序
+    """
+    import numpy as np
+
+    prices = np.asarray(prices, dtype=np.float64)
+    shares = np.zeros(len(prices), dtype=np.int64)
+    valid = np.flatnonzero(prices > 0)
+    if budget <= 0 or len(valid) == 0:
+        return shares
+
+    target = budget / len(valid)
+    fee_rate = STANDARD_FEE_RATE * fee_discount
+    p = prices[valid]
+    upper = np.floor(target * (1 + tolerance) / p).astype(np.int64)
+    start = np.minimum(odd_lot_shares(target / (1 + fee_rate), p), upper)
+    shares[valid] = start
+
+    spent = sum(buy_cost(prices[i], int(shares[i]), fee_discount) for i in valid)
+    heap = [(prices[i] * (shares[i] + 1) / target, int(i)) for i in valid]
+    heapq.heapify(heap)
+    limit = dict(zip(valid.tolist(), upper.tolist()))
+    while heap:
+        _, i = heapq.heappop(heap)
+        current = int(shares[i])
+        if current + 1 > limit[i]:
+            continue
+        extra = buy_cost(prices[i], current + 1, fee_discount) - buy_cost(prices[i], current, fee_discount)
+        if spent + extra > budget:
+            continue
+        shares[i] = current + 1
+        spent += extra
+        heapq.heappush(heap, (prices[i] * (current + 2) / target, i))
+    return shares
@@ -0,0 +1,110 @@
+"""
+權益曲線 - 以日線歷史重建投資組合每日市值、累計淨損益與最大回撤
+"""
+import numpy as np
+from fees import FEE_DISCOUNT, calc_fees_columns
+
+
+def _forward_fill(matrix):
+    """沿日期軸以前一個有效值補上 NaN (開頭沒有值的位置維持 NaN)"""
+    valid = ~np.isnan(matrix)
+    rows = np.where(valid, np.arange(matrix.shape[0])[:, None], 0)
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    return matrix[rows, np.arange(matrix.shape[1])]
+
+
+def close_matrix(history, codes, fill=True):
+    """
+    把 {code: (dates, closes)} 排成 日期 × 代碼 的收盤價矩陣，日期為所有代碼交易日的聯集，
+    fill=True 時某代碼當天沒有報價則沿用前一個交易日的收盤價；fill=False 時保留為 NaN
+    (需要判斷當天是否真的有成交時使用，例如停牌或下市的個股)
+    回傳: (dates: datetime64[D] 陣列, closes: float 矩陣，沒有報價的位置為 NaN)
+    """
+    arrays = {
+        code: (np.array(dates, dtype="datetime64[D]"), np.array(closes, dtype=np.float64))
+        for code, (dates, closes) in history.items()
+    }
+    if arrays:
+        dates = np.unique(np.concatenate([d for d, _ in arrays.values()]))
+    else:
+        dates = np.array([], dtype="datetime64[D]")
+
+    matrix = np.full((len(dates), len(codes)), np.nan)
+    for j, code in enumerate(codes):
+        if code in arrays:
+            code_dates, code_closes = arrays[code]
+            matrix[np.searchsorted(dates, code_dates), j] = code_closes
+    return dates, _forward_fill(matrix) if fill else matrix
+
+
+def compute_equity_curve(stocks, history, fee_discount=FEE_DISCOUNT):
+    """
+    以 日期 × 紀錄 的矩陣一次算出每日的投入成本與淨市值：
+    買入日 (批次起始日) 起計入，持有期間以收盤價扣除賣出手續費與證交稅估算淨值，
+    賣出日起改用實際賣價，費用規則與 calc_fees 相同 (含展延免手續費)；
+    尚無日線的日子以買入價估值
+    stocks: 含 buy_date 的股票紀錄；history: {code: (dates, closes)}
+    回傳: {"dates", "invested", "market_value", "pnl", "drawdown", "max_drawdown", "missing_codes"}
+    """
+    codes = sorted({s["stock_code"] for s in stocks})
+    missing = [code for code in codes if code not in history]
+    dates, closes = close_matrix(history, codes)
+    result = {
+        "dates": [],
+        "invested": [],
+        "market_value": [],
+        "pnl": [],
+        "drawdown": [],
+        "max_drawdown": None,
+        "missing_codes": missing
+    }
+    if not stocks or len(dates) == 0:
+        return result
+
+    code_index = {code: j for j, code in enumerate(codes)}
+    buy_price = np.array([s["buy_price"] for s in stocks], dtype=np.float64)
+    sell_price = np.array([s.get("sell_price") or 0 for s in stocks], dtype=np.float64)
+    buy_date = np.array([s["buy_date"] for s in stocks], dtype="datetime64[D]")
+    # 已賣出但沒有賣出日的紀錄視為買入當天就賣出；未賣出為 NaT (比較結果恆為 False)
+    sell_date = np.array([
+        (s.get("sell_date") or s["buy_date"]) if s.get("is_sold") else "NaT" for s in stocks
+    ], dtype="datetime64[D]")
+
+    held = dates[:, None] >= buy_date[None, :]
+    exited = dates[:, None] >= sell_date[None, :]
+    price = closes[:, [code_index[s["stock_code"]] for s in stocks]]
+    price = np.where(np.isnan(price), buy_price, price)
+    mark = np.where(exited, sell_price, price)
+
+    columns = calc_fees_columns(
+        buy_price,
+        [s["shares"] for s in stocks],
+        mark,
+        fee_discount,
+        [s.get("is_carry_over_buy", 0) == 1 for s in stocks],
+        [s.get("is_carry_over_sell", 0) == 1 for s in stocks]
+    )
+    invested = held.astype(np.float64) @ columns["total_cost"]
+    market_value = np.where(held, columns["net_value"], 0.0).sum(axis=1)
+    pnl = market_value - invested
+
+    peak = np.maximum.accumulate(pnl)
+    drawdown = pnl - peak
+    trough = int(np.argmin(drawdown))
+    peak_at = int(np.argmax(pnl[:trough + 1]))
+    base = invested[trough] + peak[trough]
+
+    result.update({
+        "dates": np.datetime_as_string(dates).tolist(),
+        "invested": invested.tolist(),
+        "market_value": market_value.tolist(),
+        "pnl": pnl.tolist(),
+        "drawdown": drawdown.tolist(),
+        "max_drawdown": {
+            "amount": float(drawdown[trough]),
+            "pct": float(drawdown[trough] / base * 100) if base > 0 else 0.0,
+            "peak_date": str(dates[peak_at]),
+            "trough_date": str(dates[trough])
+        }
+    })
+    return result
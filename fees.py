@@ -0,0 +1,188 @@
+"""
+交易成本與損益計算 - 台股手續費、證交稅與批次彙總
+numpy 只在陣列版本的計算中才載入，逐筆計算與只讀資料庫的請求不必負擔
+"""
+
+# 台股手續費標準費率
+STANDARD_FEE_RATE = 0.001425  # 0.1425%
+# 證交稅稅率
+SECURITIES_TAX_RATE = 0.003    # 0.3%
+# 手續費折讓 (固定 2.8 折)
+FEE_DISCOUNT = 0.28
+
+
+def calc_fees(buy_price, shares, price_for_sell, fee_discount, is_carry_over_buy=False, is_carry_over_sell=False):
+    """
+    計算單檔股票的交易成本
+    price_for_sell: 已賣出時傳入 sell_price，未賣出傳入 current_price
+    """
+    buy_amount = buy_price * shares
+    sell_amount = (price_for_sell or 0) * shares
+
+    buy_fee = 0 if is_carry_over_buy else int(buy_amount * STANDARD_FEE_RATE * fee_discount)  # 無條件捨去
+    sell_fee = 0 if is_carry_over_sell else int(sell_amount * STANDARD_FEE_RATE * fee_discount)
+    sell_tax = 0 if is_carry_over_sell else int(sell_amount * SECURITIES_TAX_RATE)
+
+    total_cost = buy_amount + buy_fee
+    net_value = sell_amount - sell_fee - sell_tax
+    net_pnl = net_value - total_cost
+    net_pnl_pct = ((net_value / total_cost - 1) * 100) if total_cost > 0 else 0
+
+    return {
+        "buy_amount": buy_amount,
+        "buy_fee": buy_fee,
+        "sell_amount": sell_amount,
+        "sell_fee": sell_fee,
+        "sell_tax": sell_tax,
+        "total_fees": buy_fee + sell_fee + sell_tax,
+        "total_cost": total_cost,
+        "net_value": net_value,
+        "net_pnl": net_pnl,
+        "net_pnl_pct": net_pnl_pct
+    }
+
+
+def get_effective_sell_price(stock):
+    """取得用於計算的賣出價：已賣出用 sell_price，否則用 current_price"""
+    if stock.get("is_sold"):
+        return stock.get("sell_price", 0)
+    return stock.get("current_price", 0)
+
+
+def calc_stock_fees(stock, fee_discount=FEE_DISCOUNT):
+    """依股票紀錄計算交易成本"""
+    return calc_fees(
+        stock["buy_price"], stock["shares"], get_effective_sell_price(stock), fee_discount,
+        stock.get("is_carry_over_buy", 0) == 1,
+        stock.get("is_carry_over_sell", 0) == 1
+    )
+
+
+def calc_fees_columns(buy_price, shares, price_for_sell, fee_discount, is_carry_over_buy, is_carry_over_sell):
+    """
+    calc_fees 的陣列版本：一次計算整欄紀錄的交易成本，回傳 {欄位: numpy 陣列}
+    運算順序與無條件捨去方式和 calc_fees 相同，逐筆結果完全一致
+    """
+    import numpy as np
+
+    buy_price = np.asarray(buy_price, dtype=np.float64)
+    shares = np.asarray(shares, dtype=np.int64)
+    price_for_sell = np.asarray(price_for_sell, dtype=np.float64)
+    co_buy = np.asarray(is_carry_over_buy, dtype=bool)
+    co_sell = np.asarray(is_carry_over_sell, dtype=bool)
+
+    buy_amount = buy_price * shares
+    sell_amount = price_for_sell * shares
+
+    # 金額皆非負，trunc 等同 int() 的無條件捨去
+    buy_fee = np.where(co_buy, 0, np.trunc(buy_amount * STANDARD_FEE_RATE * fee_discount)).astype(np.int64)
+    sell_fee = np.where(co_sell, 0, np.trunc(sell_amount * STANDARD_FEE_RATE * fee_discount)).astype(np.int64)
+    sell_tax = np.where(co_sell, 0, np.trunc(sell_amount * SECURITIES_TAX_RATE)).astype(np.int64)
+
+    total_cost = buy_amount + buy_fee
+    net_value = sell_amount - sell_fee - sell_tax
+    net_pnl = net_value - total_cost
+    has_cost = total_cost > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        net_pnl_pct = np.where(has_cost, (net_value / total_cost - 1) * 100, 0.0)
+
+    return {
+        "buy_amount": buy_amount,
+        "buy_fee": buy_fee,
+        "sell_amount": sell_amount,
+        "sell_fee": sell_fee,
+        "sell_tax": sell_tax,
+        "total_fees": buy_fee + sell_fee + sell_tax,
+        "total_cost": total_cost,
+        "net_value": net_value,
+        "net_pnl": net_pnl,
+        "net_pnl_pct": net_pnl_pct,
+        "has_cost": has_cost
+    }
+
+
+def calc_stock_fees_columns(stocks, fee_discount=FEE_DISCOUNT):
+    """依股票紀錄清單組成欄位後呼叫 calc_fees_columns"""
+    return calc_fees_columns(
+        [s["buy_price"] for s in stocks],
+        [s["shares"] for s in stocks],
+        [get_effective_sell_price(s) or 0 for s in stocks],
+        fee_discount,
+        [s.get("is_carry_over_buy", 0) == 1 for s in stocks],
+        [s.get("is_carry_over_sell", 0) == 1 for s in stocks]
+    )
+
+
+def calc_stock_fees_records(stocks, fee_discount=FEE_DISCOUNT):
+    """整欄計算後拆回逐筆 dict，內容 (含型別) 與逐筆呼叫 calc_stock_fees 相同"""
+    if not stocks:
+        return []
+    columns = calc_stock_fees_columns(stocks, fee_discount)
+    has_cost = columns.pop("has_cost").tolist()
+    lists = {key: values.tolist() for key, values in columns.items()}
+    records = []
+    for i in range(len(stocks)):
+        fees = {key: values[i] for key, values in lists.items()}
+        if not has_cost[i]:
+            fees["net_pnl_pct"] = 0
+        records.append(fees)
+    return records
+
+
+def _sequential_sum(values):
+    """依序累加 (與 Python 逐筆 += 的結果一致；np.sum 的成對加總可能差在最後幾位)"""
+    import numpy as np
+    return np.cumsum(values)[-1].item() if len(values) else 0
+
+
+def summarize_batch(stocks, fee_discount=FEE_DISCOUNT):
+    """
+    彙總單一批次的成本、淨值、費用、已實現/未實現損益、勝敗數與最佳/最差標的
+    stocks 需依紀錄 id 排序，確保最佳/最差標的同分時的選擇一致
+    """
+    if not stocks:
+        return {
+            "stock_count": 0,
+            "sold_count": 0,
+            "total_cost": 0,
+            "net_value": 0,
+            "total_fees": 0,
+            "realized_pnl": 0,
+            "unrealized_pnl": 0,
+            "win_count": 0,
+            "loss_count": 0,
+            "best_stock": None,
+            "worst_stock": None
+        }
+
+    import numpy as np
+
+    columns = calc_stock_fees_columns(stocks, fee_discount)
+    pnl = columns["net_pnl"]
+    cost = columns["total_cost"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pnl_pct = np.where(columns["has_cost"], pnl / cost * 100, 0.0)
+    sold = np.array([bool(s.get("is_sold")) for s in stocks])
+
+    def pick(i):
+        return {
+            "stock_code": stocks[i]["stock_code"],
+            "stock_name": stocks[i]["stock_name"],
+            "pnl": pnl[i].item(),
+            "pnl_pct": pnl_pct[i].item() if columns["has_cost"][i] else 0
+        }
+
+    # argmax / argmin 取第一個極值，與逐筆比較時使用嚴格大於/小於的結果相同
+    return {
+        "stock_count": len(stocks),
+        "sold_count": int(np.count_nonzero(sold)),
+        "total_cost": _sequential_sum(cost),
+        "net_value": _sequential_sum(columns["net_value"]),
+        "total_fees": _sequential_sum(columns["total_fees"]),
+        "realized_pnl": _sequential_sum(pnl[sold]),
+        "unrealized_pnl": _sequential_sum(pnl[~sold]),
+        "win_count": int(np.count_nonzero(pnl > 0)),
+        "loss_count": int(np.count_nonzero(pnl < 0)),
+        "best_stock": pick(int(np.argmax(pnl_pct))),
+        "worst_stock": pick(int(np.argmin(pnl_pct)))
+    }
@@ -1,8 +1,11 @@
-import yfinance as yf
 import os
 import sys
+import argparse
 import wcwidth
-import twstock
+from models import init_db
+from stock_service import get_stock_price, get_stock_prices_within
+from stock_index import get_stock_name
+from calculator import allocate_equal, odd_lot_shares, optimize_shares, DEFAULT_TOLERANCE
 
 def ljust_width(string, width):
     """根據字元實際視覺寬度進行靠左對齊補空白"""
@@ -12,44 +15,25 @@ def ljust_width(string, width):
     padding = max(0, width - current_width)
     return string + " " * padding
 
-def get_stock_name(stock_code):
-    """利用 twstock 取得中文股票名稱"""
-    stock_info = twstock.codes.get(stock_code)
-    if stock_info:
-        return stock_info.name
-    return "未知"
-
-import logging
-# 抑制 yfinance 的警告訊息
-logging.getLogger("yfinance").setLevel(logging.CRITICAL)
-
-def calculate_shares(stock_code, allocated_capital):
+def calculate_shares(stock_code, allocated_capital, price_info=None, shares=None):
     """
-    抓取最新股價並計算可以買進的零股數
+    依最新股價計算可以買進的零股數
+    price_info: get_stock_prices 批次抓到的 (price, success)；未提供時單獨抓取
+    shares: 已由最佳化模式算好的股數；未提供時以分配金額無條件捨去
     """
     stock_name = get_stock_name(stock_code)
     try:
-        try:
-            ticker = f"{stock_code}.TW"
-            stock = yf.Ticker(ticker)
-            hist = stock.history(period="1d")
-            
-            # 如果是上櫃股票，.TW 會抓不到，改嘗試 .TWO
-            if hist.empty:
-                ticker = f"{stock_code}.TWO"
-                stock = yf.Ticker(ticker)
-                hist = stock.history(period="1d")
-        except Exception:
-            pass
+        if price_info is None:
+            price_info = get_stock_price(stock_code)
+        current_price, success = price_info
 
-        if hist.empty:
+        if not success:
             print(f"警告：無法取得 {stock_code} 的股價資料。請確認代碼是否正確。")
             return stock_name, 0, 0.0, 0.0
 
-        current_price = hist['Close'].iloc[-1]
-        
         # 計算可買零股數量 (無條件捨去)
-        shares = int(allocated_capital // current_price)
+        if shares is None:
+            shares = int(odd_lot_shares(allocated_capital, current_price))
         cost = shares * current_price
         
         return stock_name, shares, current_price, cost
@@ -57,8 +41,21 @@ def calculate_shares(stock_code, allocated_capital):
         print(f"處理 {stock_code} 時發生錯誤: {e}")
         return stock_name, 0, 0.0, 0.0
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="每週台股零股試算工具")
+    parser.add_argument("--mode", choices=["equal", "optimize"], default="equal",
+                        help="equal: 平均分配後無條件捨去；optimize: 在容許偏離內盡量用完本金 (含手續費)")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help=f"optimize 模式下每檔金額可超出平均分配的比例 (預設 {DEFAULT_TOLERANCE})")
+    args = parser.parse_args()
+    if args.tolerance < 0:
+        parser.error("--tolerance 不可為負數")
+    return args
+
 def main():
+    args = parse_args()
     print("=== 每週台股零股試算工具 ===")
+    init_db()
     
     # 取得本金輸入
     try:
@@ -81,8 +78,11 @@ def main():
         print("未輸入股票代碼，程式結束。")
         return
         
-    allocated_capital = total_capital / num_stocks
-    print(f"\n總本金 {total_capital:,.0f} 元，平均分配給 {num_stocks} 檔股票，每檔分配 {allocated_capital:,.0f} 元。\n")
+    allocated_capital = allocate_equal(total_capital, num_stocks)
+    print(f"\n總本金 {total_capital:,.0f} 元，平均分配給 {num_stocks} 檔股票，每檔分配 {allocated_capital:,.0f} 元。")
+    if args.mode == "optimize":
+        print(f"最佳化模式：每檔金額最多超出平均分配 {args.tolerance:.0%}，盡量用完本金 (含手續費)。")
+    print()
     
     # 增加表格寬度以容納長股票名稱 (有些傳回英文名稱滿長的，設定寬度為 30)
     print("-" * 90)
@@ -91,9 +91,17 @@ def main():
     
     total_cost = 0
     results = []
+    prices, waited, timed_out = get_stock_prices_within(stocks)
+    if args.mode == "optimize":
+        buy_prices = [prices[code][0] if prices[code][1] else 0 for code in stocks]
+        planned = optimize_shares(total_capital, buy_prices, args.tolerance).tolist()
+    else:
+        planned = [None] * num_stocks
 
-    for stock_code in stocks:
-        stock_name, shares, price, cost = calculate_shares(stock_code, allocated_capital)
+    for stock_code, planned_shares in zip(stocks, planned):
+        stock_name, shares, price, cost = calculate_shares(
+            stock_code, allocated_capital, prices[stock_code], planned_shares
+        )
         total_cost += cost
         results.append((stock_code, stock_name, price, shares, cost))
         
@@ -107,6 +115,9 @@ def main():
     print(f"\n【試算總結】")
     print(f"預估總花費： {total_cost:,.2f} 元")
     print(f"剩餘現金：   {remaining_capital:,.2f} 元")
+    print(f"抓價等待：   {waited:.2f} 秒")
+    if timed_out:
+        print(f"逾時未取得股價：{' '.join(timed_out)}")
 
 if __name__ == "__main__":
     main()
@@ -3,81 +3,495 @@
 """
 import sqlite3
 import os
+import json
+import queue
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from fees import summarize_batch
 
 DB_PATH = os.environ.get("DB_PATH", os.path.join(os.path.dirname(__file__), "data", "stocks.db"))
 
+# 連線層級的 PRAGMA 設定，每條連線建立時套用一次
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_SIZE = int(os.environ.get("DB_CACHE_SIZE", -16000))         # 負值代表 KiB
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", 64 * 1024 * 1024))  # bytes
+# 閒置連線池大小，超過的連線歸還時直接關閉
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 4))
 
-def get_db():
-    """取得資料庫連線"""
+_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+_local = threading.local()
+
+
+def _connect():
+    """建立新連線並套用 PRAGMA"""
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+    # isolation_level=None：交易一律由 transaction() 明確控制
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA journal_mode=WAL")
     conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size={DB_CACHE_SIZE}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
     return conn
 
 
-def init_db():
-    """初始化資料表"""
+def get_db():
+    """
+    取得目前執行緒使用的資料庫連線
+    同一執行緒 (一個 Flask 請求或一個背景工作) 內重複呼叫會拿到同一條連線，
+    用完以 release_db() 歸還連線池
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            conn = _connect()
+        _local.conn = conn
+        _local.depth = 0
+    return conn
+
+
+def release_db(exc=None):
+    """歸還目前執行緒的連線 (供 Flask teardown_appcontext 與背景執行緒結束時呼叫)"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        return
+    _local.conn = None
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+
+@contextmanager
+def transaction(bump=True):
+    """
+    明確的寫入交易 (BEGIN IMMEDIATE)，正常結束時 commit，發生例外時 rollback
+    可巢狀使用：只有最外層會真正開始與結束交易，多個 model 函式因此能組成單一交易
+    bump=True 時同一交易內遞增一次資料版本 (data_version)，讓依版本快取的 API 回應失效；
+    只寫報價快取、工作狀態、租約等不影響 API 回應內容的資料表時傳 bump=False
+    """
     conn = get_db()
-    cursor = conn.cursor()
+    if _local.depth == 0:
+        conn.execute("BEGIN IMMEDIATE")
+        _local.bumped = False
+    _local.depth += 1
+    try:
+        if bump and not _local.bumped:
+            conn.execute(
+                "UPDATE data_version SET version = version + 1, updated_at = ? WHERE id = 1",
+                (time.time(),)
+            )
+            _local.bumped = True
+        yield conn
+    except BaseException:
+        _local.depth -= 1
+        if _local.depth == 0:
+            conn.rollback()
+        raise
+    _local.depth -= 1
+    if _local.depth == 0:
+        conn.commit()
 
-    # 1. 建立資料表（不含可能缺少的欄位）
-    cursor.executescript("""
-        CREATE TABLE IF NOT EXISTS config (
-            id INTEGER PRIMARY KEY CHECK (id = 1),
-            initial_capital REAL NOT NULL DEFAULT 0,
-            created_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
-            updated_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
-        );
-
-        CREATE TABLE IF NOT EXISTS batch (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            start_date TEXT NOT NULL,
-            allocated_capital REAL NOT NULL DEFAULT 0,
-            created_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
-        );
 
-        CREATE TABLE IF NOT EXISTS stock_record (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            batch_id INTEGER NOT NULL,
+# ============ Schema Migrations ============
+
+# 第 1 版結構：建立所有資料表 (CREATE ... IF NOT EXISTS，已存在的舊資料庫也可套用)
+_SCHEMA_V1 = """
+    CREATE TABLE IF NOT EXISTS config (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        initial_capital REAL NOT NULL DEFAULT 0,
+        created_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+        updated_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+    );
+
+    CREATE TABLE IF NOT EXISTS batch (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        start_date TEXT NOT NULL,
+        allocated_capital REAL NOT NULL DEFAULT 0,
+        created_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+    );
+
+    CREATE TABLE IF NOT EXISTS stock_record (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        batch_id INTEGER NOT NULL,
+        stock_code TEXT NOT NULL,
+        stock_name TEXT NOT NULL DEFAULT '未知',
+        buy_price REAL NOT NULL DEFAULT 0,
+        shares INTEGER NOT NULL DEFAULT 0,
+        current_price REAL DEFAULT 0,
+        price_updated_at TEXT,
+        is_carry_over_buy INTEGER NOT NULL DEFAULT 0,
+        is_carry_over_sell INTEGER NOT NULL DEFAULT 0,
+        linked_carry_over_id INTEGER,
+        created_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+        FOREIGN KEY (batch_id) REFERENCES batch(id) ON DELETE CASCADE
+    );
+
+    -- 批次彙總 (物化)，由寫入 stock_record 的 model 函式在同一交易內更新
+    CREATE TABLE IF NOT EXISTS batch_summary (
+        batch_id INTEGER PRIMARY KEY,
+        stock_count INTEGER NOT NULL DEFAULT 0,
+        sold_count INTEGER NOT NULL DEFAULT 0,
+        total_cost REAL NOT NULL DEFAULT 0,
+        net_value REAL NOT NULL DEFAULT 0,
+        total_fees REAL NOT NULL DEFAULT 0,
+        realized_pnl REAL NOT NULL DEFAULT 0,
+        unrealized_pnl REAL NOT NULL DEFAULT 0,
+        win_count INTEGER NOT NULL DEFAULT 0,
+        loss_count INTEGER NOT NULL DEFAULT 0,
+        best_stock TEXT,
+        worst_stock TEXT,
+        updated_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+        FOREIGN KEY (batch_id) REFERENCES batch(id) ON DELETE CASCADE
+    );
+
+    -- 報價快取：多個 gunicorn worker 共用，fetched_at / refreshing_until 為 epoch 秒
+    CREATE TABLE IF NOT EXISTS quote (
+        stock_code TEXT PRIMARY KEY,
+        price REAL NOT NULL,
+        fetched_at REAL NOT NULL,
+        refreshing_until REAL NOT NULL DEFAULT 0
+    );
+
+    -- 代碼對應的 Yahoo 後綴 (.TW 上市 / .TWO 上櫃)，source 記錄來源 (twstock / fetch)
+    CREATE TABLE IF NOT EXISTS stock_market (
+        stock_code TEXT PRIMARY KEY,
+        suffix TEXT NOT NULL,
+        source TEXT NOT NULL,
+        updated_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+    );
+
+    -- 背景股價更新工作，status: pending / running / done / failed
+    CREATE TABLE IF NOT EXISTS refresh_job (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        trigger TEXT NOT NULL DEFAULT 'manual',
+        batch_id INTEGER,
+        total INTEGER NOT NULL DEFAULT 0,
+        done INTEGER NOT NULL DEFAULT 0,
+        updated INTEGER NOT NULL DEFAULT 0,
+        result TEXT,
+        error TEXT,
+        created_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+        started_at TEXT,
+        finished_at TEXT
+    );
+
+    -- 跨 worker 的排程租約，確保同一時間只有一個 worker 執行定時工作
+    CREATE TABLE IF NOT EXISTS scheduler_lease (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    );
+
+    -- 資料版本：每個會改變 API 回應內容的寫入交易遞增一次，供 ETag 與回應快取使用
+    CREATE TABLE IF NOT EXISTS data_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL,
+        updated_at REAL NOT NULL
+    );
+
+    -- 異動紀錄：每個批次 / 股票紀錄只保留最後一次異動的資料版本，刪除時留下 deleted=1
+    CREATE TABLE IF NOT EXISTS change_log (
+        entity TEXT NOT NULL,          -- batch / stock
+        entity_id INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        deleted INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (entity, entity_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_change_log_version ON change_log(version);
+"""
+
+# 舊資料庫可能缺少的欄位：(資料表, 欄位, 欄位定義)
+_SCHEMA_V1_COLUMNS = [
+    ("config", "fee_discount", "REAL NOT NULL DEFAULT 0.28"),
+    ("stock_record", "is_sold", "INTEGER NOT NULL DEFAULT 0"),
+    ("stock_record", "sell_price", "REAL DEFAULT 0"),
+    ("stock_record", "sell_date", "TEXT"),
+    ("stock_record", "is_carry_over_buy", "INTEGER NOT NULL DEFAULT 0"),
+    ("stock_record", "is_carry_over_sell", "INTEGER NOT NULL DEFAULT 0"),
+    ("stock_record", "linked_carry_over_id", "INTEGER"),
+]
+
+
+def _execute_script(conn, script):
+    """在目前交易內逐句執行 SQL 腳本 (executescript 會先自行 commit，無法放進交易)"""
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            conn.execute(statement)
+            statement = ""
+
+
+def _migrate_v1(conn):
+    """建立資料表、補齊舊資料庫缺少的欄位、初始化單列資料表並補建批次彙總"""
+    _execute_script(conn, _SCHEMA_V1)
+
+    for table, column, definition in _SCHEMA_V1_COLUMNS:
+        columns = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    conn.execute("INSERT OR IGNORE INTO config (id, initial_capital, fee_discount) VALUES (1, 0, 0.28)")
+    conn.execute("INSERT OR IGNORE INTO data_version (id, version, updated_at) VALUES (1, 1, ?)", (time.time(),))
+
+    rows = conn.execute(
+        "SELECT id FROM batch WHERE id NOT IN (SELECT batch_id FROM batch_summary)"
+    ).fetchall()
+    _refresh_batch_summaries(conn, [r["id"] for r in rows])
+
+
+def _migrate_v2(conn):
+    """為 models 中的熱門查詢建立索引"""
+    _execute_script(conn, """
+        -- 依批次讀取紀錄 (明細、彙總重算、刪除批次)，依 id 排序
+        CREATE INDEX IF NOT EXISTS idx_stock_record_batch ON stock_record(batch_id, id);
+        -- 依代碼更新現價、依代碼篩選批次
+        CREATE INDEX IF NOT EXISTS idx_stock_record_code ON stock_record(stock_code, batch_id);
+        -- 未賣出紀錄 (背景更新、即時推播)
+        CREATE INDEX IF NOT EXISTS idx_stock_record_open ON stock_record(is_sold, batch_id);
+        -- 取消展延時查詢對應的新紀錄
+        CREATE INDEX IF NOT EXISTS idx_stock_record_linked ON stock_record(linked_carry_over_id)
+            WHERE linked_carry_over_id IS NOT NULL;
+        -- 批次列表排序與 keyset 分頁
+        CREATE INDEX IF NOT EXISTS idx_batch_start ON batch(start_date, id);
+        -- 查詢進行中的更新工作
+        CREATE INDEX IF NOT EXISTS idx_refresh_job_status ON refresh_job(status, batch_id);
+    """)
+
+
+def _migrate_v3(conn):
+    """日線歷史資料：以 (代碼, 日期) 為主鍵的 WITHOUT ROWID 表，同代碼的資料在磁碟上連續存放"""
+    _execute_script(conn, """
+        CREATE TABLE IF NOT EXISTS price_history (
             stock_code TEXT NOT NULL,
-            stock_name TEXT NOT NULL DEFAULT '未知',
-            buy_price REAL NOT NULL DEFAULT 0,
-            shares INTEGER NOT NULL DEFAULT 0,
-            current_price REAL DEFAULT 0,
-            price_updated_at TEXT,
-            is_carry_over_buy INTEGER NOT NULL DEFAULT 0,
-            is_carry_over_sell INTEGER NOT NULL DEFAULT 0,
-            linked_carry_over_id INTEGER,
-            created_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
-            FOREIGN KEY (batch_id) REFERENCES batch(id) ON DELETE CASCADE
-        );
+            date TEXT NOT NULL,            -- YYYY-MM-DD (台北時間交易日)
+            open REAL,
+            high REAL,
+            low REAL,
+            close REAL NOT NULL,
+            volume INTEGER,
+            PRIMARY KEY (stock_code, date)
+        ) WITHOUT ROWID;
+
+        -- 每個代碼已向上游查詢過的日期區間 (含無交易的假日)，補抓時只抓區間外的日期
+        CREATE TABLE IF NOT EXISTS price_history_range (
+            stock_code TEXT PRIMARY KEY,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL
+        ) WITHOUT ROWID;
     """)
 
-    # 2. 升級：若舊資料庫缺少欄位，自動新增
-    migrations = [
-        "ALTER TABLE config ADD COLUMN fee_discount REAL NOT NULL DEFAULT 0.28",
-        "ALTER TABLE stock_record ADD COLUMN is_sold INTEGER NOT NULL DEFAULT 0",
-        "ALTER TABLE stock_record ADD COLUMN sell_price REAL DEFAULT 0",
-        "ALTER TABLE stock_record ADD COLUMN sell_date TEXT",
-        "ALTER TABLE stock_record ADD COLUMN is_carry_over_buy INTEGER NOT NULL DEFAULT 0",
-        "ALTER TABLE stock_record ADD COLUMN is_carry_over_sell INTEGER NOT NULL DEFAULT 0",
-        "ALTER TABLE stock_record ADD COLUMN linked_carry_over_id INTEGER",
-    ]
-    for sql in migrations:
-        try:
-            cursor.execute(sql)
-        except sqlite3.OperationalError:
-            pass  # 欄位已存在
 
-    # 3. 確保 config 只有一筆
-    cursor.execute("INSERT OR IGNORE INTO config (id, initial_capital, fee_discount) VALUES (1, 0, 0.28)")
+def _migrate_v4(conn):
+    """更新工作記錄執行的 worker 與最後回報時間，worker 中途結束的工作才能判定為逾時"""
+    _execute_script(conn, """
+        ALTER TABLE refresh_job ADD COLUMN owner TEXT;
+        -- 最後一次回報進度的時間 (UNIX 秒)
+        ALTER TABLE refresh_job ADD COLUMN heartbeat_at REAL;
+    """)
+
 
-    conn.commit()
-    conn.close()
+# 依序套用的遷移，第 i 個 (從 0 起算) 把 user_version 從 i 升到 i + 1；只能在尾端新增
+MIGRATIONS = [_migrate_v1, _migrate_v2, _migrate_v3, _migrate_v4]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def init_db():
+    """
+    確認資料庫結構為最新版本 (PRAGMA user_version)，必要時套用尚未執行的遷移
+    已是最新版時只讀一次 user_version；多個 worker 同時啟動時由 BEGIN IMMEDIATE 排隊，
+    取得寫入鎖後重新讀取版本，因此每個遷移只會執行一次
+    """
+    conn = get_db()
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+        with transaction(bump=False):
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            for version in range(current, SCHEMA_VERSION):
+                MIGRATIONS[version](conn)
+                conn.execute(f"PRAGMA user_version = {version + 1}")
+    finally:
+        release_db()
+
+
+# ============ Data Version ============
+
+def get_data_version():
+    """目前的資料版本與最後寫入時間 (UNIX 秒)，供 API 判斷回應是否變動"""
+    row = get_db().execute("SELECT version, updated_at FROM data_version WHERE id = 1").fetchone()
+    return row["version"], row["updated_at"]
+
+
+def _log_changes(conn, entity, entity_ids, deleted=False):
+    """記錄批次 / 股票紀錄在目前資料版本的異動，需在寫入交易內呼叫"""
+    conn.executemany(
+        """INSERT OR REPLACE INTO change_log (entity, entity_id, version, deleted)
+           VALUES (?, ?, (SELECT version FROM data_version WHERE id = 1), ?)""",
+        [(entity, entity_id, 1 if deleted else 0) for entity_id in set(entity_ids) if entity_id is not None]
+    )
+
+
+def get_changes(since):
+    """
+    取得資料版本 since 之後異動的批次彙總與股票紀錄，以及已刪除的 ID
+    回傳 {"batches", "stocks", "deleted_batches", "deleted_stocks"}
+    """
+    conn = get_db()
+    rows = conn.execute(
+        "SELECT entity, entity_id, deleted FROM change_log WHERE version > ?", (since,)
+    ).fetchall()
+    changed = {"batch": [], "stock": []}
+    deleted = {"batch": [], "stock": []}
+    for r in rows:
+        (deleted if r["deleted"] else changed)[r["entity"]].append(r["entity_id"])
+    batches = get_batch_summaries(changed["batch"]) if changed["batch"] else []
+    stocks = get_stock_records(changed["stock"])
+    # 記錄為異動但已不存在的 ID (例如對已刪除紀錄的更新) 一律視為刪除
+    found_batches = {b["id"] for b in batches}
+    found_stocks = {s["id"] for s in stocks}
+    deleted["batch"] += [i for i in changed["batch"] if i not in found_batches]
+    deleted["stock"] += [i for i in changed["stock"] if i not in found_stocks]
+    return {
+        "batches": batches,
+        "stocks": stocks,
+        "deleted_batches": sorted(deleted["batch"]),
+        "deleted_stocks": sorted(deleted["stock"])
+    }
+
+
+# ============ Batch Summary ============
+
+def _refresh_batch_summaries(conn, batch_ids):
+    """重新計算指定批次的彙總並寫回 batch_summary，需在寫入交易內呼叫"""
+    for batch_id in set(batch_ids):
+        if batch_id is None:
+            continue
+        stocks = [dict(r) for r in conn.execute(
+            "SELECT * FROM stock_record WHERE batch_id = ? ORDER BY id", (batch_id,)
+        ).fetchall()]
+        summary = summarize_batch(stocks)
+        conn.execute(
+            """INSERT OR REPLACE INTO batch_summary (
+                   batch_id, stock_count, sold_count, total_cost, net_value, total_fees,
+                   realized_pnl, unrealized_pnl, win_count, loss_count, best_stock, worst_stock
+               ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (
+                batch_id, summary["stock_count"], summary["sold_count"], summary["total_cost"],
+                summary["net_value"], summary["total_fees"], summary["realized_pnl"],
+                summary["unrealized_pnl"], summary["win_count"], summary["loss_count"],
+                json.dumps(summary["best_stock"], ensure_ascii=False) if summary["best_stock"] else None,
+                json.dumps(summary["worst_stock"], ensure_ascii=False) if summary["worst_stock"] else None,
+            )
+        )
+    _log_changes(conn, "batch", batch_ids)
+
+
+def _batch_ids_of_records(conn, record_ids):
+    """查詢股票紀錄所屬的批次 ID"""
+    record_ids = list(record_ids)
+    if not record_ids:
+        return set()
+    placeholders = ",".join("?" * len(record_ids))
+    rows = conn.execute(
+        f"SELECT DISTINCT batch_id FROM stock_record WHERE id IN ({placeholders})",
+        record_ids
+    ).fetchall()
+    return {r["batch_id"] for r in rows}
+
+
+def _summary_row_to_dict(row):
+    summary = dict(row)
+    summary["best_stock"] = json.loads(summary["best_stock"]) if summary["best_stock"] else None
+    summary["worst_stock"] = json.loads(summary["worst_stock"]) if summary["worst_stock"] else None
+    summary["is_closed"] = summary["stock_count"] > 0 and summary["sold_count"] == summary["stock_count"]
+    return summary
+
+
+def get_batch_summaries(batch_ids=None, limit=None, after=None, status=None,
+                        date_from=None, date_to=None, stock_code=None):
+    """
+    取得批次及其物化彙總，排序與 get_all_batches 相同 (start_date DESC, id DESC)
+    batch_ids: 限定批次 ID；status: "open" / "closed"；date_from / date_to: 起始日範圍 (含)；
+    stock_code: 只取含該代碼紀錄的批次
+    limit / after: keyset 分頁，after 為上一頁最後一筆的 (start_date, id)，
+    依 (start_date, id) 索引接續讀取，不需跳過前面的列
+    """
+    conditions, params = [], []
+    if batch_ids is not None:
+        batch_ids = list(batch_ids)
+        conditions.append(f"b.id IN ({','.join('?' * len(batch_ids))})")
+        params += batch_ids
+    if status == "closed":
+        conditions.append("s.stock_count > 0 AND s.sold_count = s.stock_count")
+    elif status == "open":
+        conditions.append("NOT (s.stock_count > 0 AND s.sold_count = s.stock_count)")
+    if date_from:
+        conditions.append("b.start_date >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("b.start_date <= ?")
+        params.append(date_to)
+    if stock_code:
+        conditions.append("EXISTS (SELECT 1 FROM stock_record sr WHERE sr.batch_id = b.id AND sr.stock_code = ?)")
+        params.append(stock_code)
+    if after is not None:
+        conditions.append("(b.start_date, b.id) < (?, ?)")
+        params += list(after)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    limit_sql = ""
+    if limit is not None:
+        limit_sql = "LIMIT ?"
+        params.append(limit)
+
+    conn = get_db()
+    rows = conn.execute(f"""
+        SELECT b.*, s.stock_count, s.sold_count, s.total_cost, s.net_value, s.total_fees,
+               s.realized_pnl, s.unrealized_pnl, s.win_count, s.loss_count, s.best_stock, s.worst_stock
+        FROM batch b
+        JOIN batch_summary s ON s.batch_id = b.id
+        {where}
+        ORDER BY b.start_date DESC, b.id DESC
+        {limit_sql}
+    """, params).fetchall()
+    return [_summary_row_to_dict(r) for r in rows]
+
+
+def get_batch_summary_page(limit, after=None, **filters):
+    """
+    取得一頁批次彙總，回傳 (批次列表, 下一頁游標)
+    多讀一筆判斷是否還有下一頁，沒有時游標為 None
+    """
+    rows = get_batch_summaries(limit=limit + 1, after=after, **filters)
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, (rows[-1]["start_date"], rows[-1]["id"])
+
+
+def get_portfolio_totals():
+    """以 SQL 加總所有批次彙總 (不把每個批次讀進 Python)"""
+    row = get_db().execute("""
+        SELECT COUNT(*) AS batch_count,
+               COALESCE(SUM(total_cost), 0) AS total_cost,
+               COALESCE(SUM(net_value), 0) AS net_value,
+               COALESCE(SUM(total_fees), 0) AS total_fees,
+               COALESCE(SUM(realized_pnl), 0) AS realized_pnl,
+               COALESCE(SUM(unrealized_pnl), 0) AS unrealized_pnl
+        FROM batch_summary
+    """).fetchone()
+    return dict(row)
 
 
 # ============ Config CRUD ============
@@ -85,7 +499,6 @@ def init_db():
 def get_config():
     conn = get_db()
     row = conn.execute("SELECT * FROM config WHERE id = 1").fetchone()
-    conn.close()
     result = dict(row) if row else {"id": 1, "initial_capital": 0, "fee_discount": 0.28}
     # 確保 fee_discount 存在
     if "fee_discount" not in result:
@@ -94,72 +507,67 @@ def get_config():
 
 
 def update_config(initial_capital, fee_discount=0.28):
-    conn = get_db()
-    conn.execute(
-        "UPDATE config SET initial_capital = ?, fee_discount = ?, updated_at = datetime('now', 'localtime') WHERE id = 1",
-        (initial_capital, fee_discount)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE config SET initial_capital = ?, fee_discount = ?, updated_at = datetime('now', 'localtime') WHERE id = 1",
+            (initial_capital, fee_discount)
+        )
 
 
 # ============ Batch CRUD ============
 
 def create_batch(name, start_date, allocated_capital):
-    conn = get_db()
-    cursor = conn.execute(
-        "INSERT INTO batch (name, start_date, allocated_capital) VALUES (?, ?, ?)",
-        (name, start_date, allocated_capital)
-    )
-    batch_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return batch_id
+    with transaction() as conn:
+        cursor = conn.execute(
+            "INSERT INTO batch (name, start_date, allocated_capital) VALUES (?, ?, ?)",
+            (name, start_date, allocated_capital)
+        )
+        _refresh_batch_summaries(conn, [cursor.lastrowid])
+    return cursor.lastrowid
 
 
 def get_all_batches():
     conn = get_db()
     rows = conn.execute("SELECT * FROM batch ORDER BY start_date DESC, id DESC").fetchall()
-    conn.close()
     return [dict(r) for r in rows]
 
 
 def get_batch(batch_id):
     conn = get_db()
     row = conn.execute("SELECT * FROM batch WHERE id = ?", (batch_id,)).fetchone()
-    conn.close()
     return dict(row) if row else None
 
 
 def update_batch(batch_id, name, start_date, allocated_capital):
-    conn = get_db()
-    conn.execute(
-        "UPDATE batch SET name = ?, start_date = ?, allocated_capital = ? WHERE id = ?",
-        (name, start_date, allocated_capital, batch_id)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE batch SET name = ?, start_date = ?, allocated_capital = ? WHERE id = ?",
+            (name, start_date, allocated_capital, batch_id)
+        )
+        _log_changes(conn, "batch", [batch_id])
 
 
 def delete_batch(batch_id):
-    conn = get_db()
-    conn.execute("DELETE FROM batch WHERE id = ?", (batch_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        record_ids = [r["id"] for r in conn.execute(
+            "SELECT id FROM stock_record WHERE batch_id = ?", (batch_id,)
+        ).fetchall()]
+        conn.execute("DELETE FROM batch WHERE id = ?", (batch_id,))
+        _log_changes(conn, "stock", record_ids, deleted=True)
+        _log_changes(conn, "batch", [batch_id], deleted=True)
 
 
 # ============ StockRecord CRUD ============
 
 def add_stock_record(batch_id, stock_code, stock_name, buy_price, shares):
-    conn = get_db()
-    cursor = conn.execute(
-        "INSERT INTO stock_record (batch_id, stock_code, stock_name, buy_price, shares) VALUES (?, ?, ?, ?, ?)",
-        (batch_id, stock_code, stock_name, buy_price, shares)
-    )
-    record_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return record_id
+    with transaction() as conn:
+        cursor = conn.execute(
+            "INSERT INTO stock_record (batch_id, stock_code, stock_name, buy_price, shares) VALUES (?, ?, ?, ?, ?)",
+            (batch_id, stock_code, stock_name, buy_price, shares)
+        )
+        _log_changes(conn, "stock", [cursor.lastrowid])
+        _refresh_batch_summaries(conn, [batch_id])
+    return cursor.lastrowid
 
 
 def get_stocks_by_batch(batch_id):
@@ -168,110 +576,464 @@ def get_stocks_by_batch(batch_id):
         "SELECT * FROM stock_record WHERE batch_id = ? ORDER BY id",
         (batch_id,)
     ).fetchall()
-    conn.close()
     return [dict(r) for r in rows]
 
 
 def update_stock_record(record_id, buy_price, shares):
-    conn = get_db()
-    conn.execute(
-        "UPDATE stock_record SET buy_price = ?, shares = ? WHERE id = ?",
-        (buy_price, shares, record_id)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE stock_record SET buy_price = ?, shares = ? WHERE id = ?",
+            (buy_price, shares, record_id)
+        )
+        _log_changes(conn, "stock", [record_id])
+        _refresh_batch_summaries(conn, _batch_ids_of_records(conn, [record_id]))
 
 
 def update_stock_current_price(record_id, current_price):
-    conn = get_db()
-    conn.execute(
-        "UPDATE stock_record SET current_price = ?, price_updated_at = datetime('now', 'localtime') WHERE id = ?",
-        (current_price, record_id)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE stock_record SET current_price = ?, price_updated_at = datetime('now', 'localtime') WHERE id = ?",
+            (current_price, record_id)
+        )
+        _log_changes(conn, "stock", [record_id])
+        _refresh_batch_summaries(conn, _batch_ids_of_records(conn, [record_id]))
+
+
+def update_stock_current_prices(prices, key="id"):
+    """
+    以單一交易 (executemany) 批次更新未賣出紀錄的現價，只 commit 一次
+    key="id": prices 為 {record_id: price}；key="stock_code": prices 為 {stock_code: price}，
+    同代碼的所有未賣出紀錄一併更新
+    回傳更新筆數
+    """
+    if not prices:
+        return 0
+    if key not in ("id", "stock_code"):
+        raise ValueError(f"不支援的 key: {key}")
+    keys = list(prices.keys())
+    placeholders = ",".join("?" * len(keys))
+    with transaction() as conn:
+        targets = conn.execute(
+            f"SELECT id, batch_id FROM stock_record WHERE is_sold = 0 AND {key} IN ({placeholders})",
+            keys
+        ).fetchall()
+        cursor = conn.executemany(
+            f"UPDATE stock_record SET current_price = ?, price_updated_at = datetime('now', 'localtime') WHERE {key} = ? AND is_sold = 0",
+            [(price, k) for k, price in prices.items()]
+        )
+        _log_changes(conn, "stock", [r["id"] for r in targets])
+        _refresh_batch_summaries(conn, {r["batch_id"] for r in targets})
+    return cursor.rowcount
 
 
 def delete_stock_record(record_id):
-    conn = get_db()
-    conn.execute("DELETE FROM stock_record WHERE id = ?", (record_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        batch_ids = _batch_ids_of_records(conn, [record_id])
+        conn.execute("DELETE FROM stock_record WHERE id = ?", (record_id,))
+        _log_changes(conn, "stock", [record_id], deleted=True)
+        _refresh_batch_summaries(conn, batch_ids)
 
 
 def sell_stock(record_id, sell_price, sell_date):
     """標記股票為已賣出"""
-    conn = get_db()
-    conn.execute(
-        "UPDATE stock_record SET is_sold = 1, sell_price = ?, sell_date = ? WHERE id = ?",
-        (sell_price, sell_date, record_id)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE stock_record SET is_sold = 1, sell_price = ?, sell_date = ? WHERE id = ?",
+            (sell_price, sell_date, record_id)
+        )
+        _log_changes(conn, "stock", [record_id])
+        _refresh_batch_summaries(conn, _batch_ids_of_records(conn, [record_id]))
 
 
 def unsell_stock(record_id):
     """取消賣出狀態，如果是由展延產生的賣出，則一併將新批次對應的該檔未賣出買入記錄刪除"""
-    conn = get_db()
-    
-    # 1. 檢查是否有 linked_carry_over_id
-    row = conn.execute("SELECT linked_carry_over_id FROM stock_record WHERE id = ?", (record_id,)).fetchone()
-    if row and row["linked_carry_over_id"]:
-        linked_id = row["linked_carry_over_id"]
-        # 將對應的新股票記錄也一併刪除
-        conn.execute("DELETE FROM stock_record WHERE id = ?", (linked_id,))
-    
-    # 2. 恢復持有狀態並清空關聯欄位
-    conn.execute(
-        "UPDATE stock_record SET is_sold = 0, sell_price = 0, sell_date = NULL, is_carry_over_sell = 0, linked_carry_over_id = NULL WHERE id = ?",
-        (record_id,)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        batch_ids = _batch_ids_of_records(conn, [record_id])
+
+        # 1. 檢查是否有 linked_carry_over_id
+        row = conn.execute("SELECT linked_carry_over_id FROM stock_record WHERE id = ?", (record_id,)).fetchone()
+        if row and row["linked_carry_over_id"]:
+            linked_id = row["linked_carry_over_id"]
+            batch_ids |= _batch_ids_of_records(conn, [linked_id])
+            # 將對應的新股票記錄也一併刪除
+            conn.execute("DELETE FROM stock_record WHERE id = ?", (linked_id,))
+            _log_changes(conn, "stock", [linked_id], deleted=True)
+        
+        # 2. 恢復持有狀態並清空關聯欄位
+        conn.execute(
+            "UPDATE stock_record SET is_sold = 0, sell_price = 0, sell_date = NULL, is_carry_over_sell = 0, linked_carry_over_id = NULL WHERE id = ?",
+            (record_id,)
+        )
+        _log_changes(conn, "stock", [record_id])
+        _refresh_batch_summaries(conn, batch_ids)
 
 
 def move_stock_to_batch(record_id, new_batch_id, carry_price, carry_date):
     """將單一股票紀錄展延（搬移）到另一個批次：將當前標記為賣出，並在新批次建立新的一筆"""
+    with transaction() as conn:
+        row = conn.execute("SELECT * FROM stock_record WHERE id = ?", (record_id,)).fetchone()
+        if not row:
+            return
+
+        old_stock = dict(row)
+
+        # 1. 將舊紀錄標記為展延賣出 (先把 linked 留空，底下補上)
+        conn.execute(
+            "UPDATE stock_record SET is_sold = 1, sell_price = ?, sell_date = ?, is_carry_over_sell = 1 WHERE id = ?",
+            (carry_price, carry_date, record_id)
+        )
+
+        # 2. 在新批次建立展延買入紀錄
+        cursor = conn.execute(
+            "INSERT INTO stock_record (batch_id, stock_code, stock_name, buy_price, shares, is_carry_over_buy) VALUES (?, ?, ?, ?, ?, 1)",
+            (new_batch_id, old_stock["stock_code"], old_stock["stock_name"], carry_price, old_stock["shares"])
+        )
+        new_record_id = cursor.lastrowid
+        
+        # 3. 把新建立的那筆 ID 寫回舊紀錄的 linked_carry_over_id 欄位中
+        conn.execute(
+            "UPDATE stock_record SET linked_carry_over_id = ? WHERE id = ?",
+            (new_record_id, record_id)
+        )
+        _log_changes(conn, "stock", [record_id, new_record_id])
+        _refresh_batch_summaries(conn, [old_stock["batch_id"], new_batch_id])
+
+
+def save_batch_full(batch_id, name, start_date, allocated_capital, stocks):
+    """
+    以單一交易儲存整個批次：建立或更新批次表頭，更新既有股票紀錄並新增其餘紀錄
+    batch_id 為 None 時建立新批次
+    stocks: [{"record_id", "stock_code", "stock_name", "buy_price", "shares"}]，
+    有 record_id 的更新該筆 (僅限本批次的紀錄)，沒有的新增；未列出的既有紀錄保持不變
+    回傳批次 ID，批次不存在時回傳 None
+    """
+    with transaction() as conn:
+        if batch_id is None:
+            cursor = conn.execute(
+                "INSERT INTO batch (name, start_date, allocated_capital) VALUES (?, ?, ?)",
+                (name, start_date, allocated_capital)
+            )
+            batch_id = cursor.lastrowid
+        else:
+            cursor = conn.execute(
+                "UPDATE batch SET name = ?, start_date = ?, allocated_capital = ? WHERE id = ?",
+                (name, start_date, allocated_capital, batch_id)
+            )
+            if cursor.rowcount == 0:
+                return None
+
+        updates = [(s["buy_price"], s["shares"], s["record_id"], batch_id) for s in stocks if s.get("record_id")]
+        conn.executemany(
+            "UPDATE stock_record SET buy_price = ?, shares = ? WHERE id = ? AND batch_id = ?",
+            updates
+        )
+        # AUTOINCREMENT 的 ID 只增不減，新增的紀錄即本批次中大於新增前最大 ID 的那些
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM stock_record").fetchone()[0]
+        conn.executemany(
+            "INSERT INTO stock_record (batch_id, stock_code, stock_name, buy_price, shares) VALUES (?, ?, ?, ?, ?)",
+            [(batch_id, s["stock_code"], s["stock_name"], s["buy_price"], s["shares"])
+             for s in stocks if not s.get("record_id")]
+        )
+        inserted = [r["id"] for r in conn.execute(
+            "SELECT id FROM stock_record WHERE batch_id = ? AND id > ?", (batch_id, last_id)
+        ).fetchall()]
+        _log_changes(conn, "stock", [u[2] for u in updates] + inserted)
+        _refresh_batch_summaries(conn, [batch_id])
+    return batch_id
+
+
+def get_stock_records(record_ids):
+    """依 ID 取得股票紀錄 (依 ID 排序)"""
+    record_ids = list(record_ids)
+    if not record_ids:
+        return []
     conn = get_db()
-    
-    row = conn.execute("SELECT * FROM stock_record WHERE id = ?", (record_id,)).fetchone()
-    if not row:
-        conn.close()
+    rows = conn.execute(
+        f"SELECT * FROM stock_record WHERE id IN ({','.join('?' * len(record_ids))}) ORDER BY id",
+        record_ids
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def get_open_stock_records(batch_id=None):
+    """取得未賣出的股票紀錄，可限定單一批次"""
+    conn = get_db()
+    if batch_id is None:
+        rows = conn.execute("SELECT * FROM stock_record WHERE is_sold = 0 ORDER BY id").fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT * FROM stock_record WHERE is_sold = 0 AND batch_id = ? ORDER BY id",
+            (batch_id,)
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def get_open_stock_prices():
+    """取得未賣出紀錄的 {紀錄 ID: 現價}，供即時推播比對價格變動 (只讀兩個欄位)"""
+    conn = get_db()
+    rows = conn.execute("SELECT id, current_price FROM stock_record WHERE is_sold = 0").fetchall()
+    return {r["id"]: r["current_price"] for r in rows}
+
+
+def get_records_with_buy_date(batch_id=None):
+    """取得股票紀錄並附上買入日 (所屬批次的起始日，展延買入即展延日)，可限定單一批次，依 ID 排序"""
+    conn = get_db()
+    rows = conn.execute("""
+        SELECT sr.*, b.start_date AS buy_date
+        FROM stock_record sr
+        JOIN batch b ON b.id = sr.batch_id
+        WHERE ? IS NULL OR sr.batch_id = ?
+        ORDER BY sr.id
+    """, (batch_id, batch_id)).fetchall()
+    return [dict(r) for r in rows]
+
+
+# ============ Quote Cache ============
+
+def get_cached_quotes(stock_codes):
+    """取得快取中的報價，回傳 {stock_code: {"price", "fetched_at", "refreshing_until"}}"""
+    codes = list(stock_codes)
+    if not codes:
+        return {}
+    conn = get_db()
+    placeholders = ",".join("?" * len(codes))
+    rows = conn.execute(
+        f"SELECT * FROM quote WHERE stock_code IN ({placeholders})",
+        codes
+    ).fetchall()
+    return {r["stock_code"]: dict(r) for r in rows}
+
+
+def save_quotes(prices, fetched_at):
+    """寫入報價快取，prices: {stock_code: price}；同時解除刷新中的標記"""
+    if not prices:
         return
+    with transaction(bump=False) as conn:
+        conn.executemany(
+            """INSERT INTO quote (stock_code, price, fetched_at, refreshing_until) VALUES (?, ?, ?, 0)
+               ON CONFLICT(stock_code) DO UPDATE SET
+                   price = excluded.price, fetched_at = excluded.fetched_at, refreshing_until = 0""",
+            [(code, price, fetched_at) for code, price in prices.items()]
+        )
 
-    old_stock = dict(row)
 
-    # 1. 將舊紀錄標記為展延賣出 (先把 linked 留空，底下補上)
-    conn.execute(
-        "UPDATE stock_record SET is_sold = 1, sell_price = ?, sell_date = ?, is_carry_over_sell = 1 WHERE id = ?",
-        (carry_price, carry_date, record_id)
-    )
+def claim_quote_refresh(stock_codes, now, lease_seconds):
+    """
+    搶佔報價的背景刷新權，避免多個 worker 同時對同一代碼重抓
+    回傳成功搶到的代碼清單
+    """
+    codes = list(stock_codes)
+    if not codes:
+        return []
+    with transaction(bump=False) as conn:
+        placeholders = ",".join("?" * len(codes))
+        rows = conn.execute(
+            f"SELECT stock_code FROM quote WHERE stock_code IN ({placeholders}) AND refreshing_until < ?",
+            codes + [now]
+        ).fetchall()
+        claimed = [r["stock_code"] for r in rows]
+        if claimed:
+            placeholders = ",".join("?" * len(claimed))
+            conn.execute(
+                f"UPDATE quote SET refreshing_until = ? WHERE stock_code IN ({placeholders})",
+                [now + lease_seconds] + claimed
+            )
+    return claimed
 
-    # 2. 在新批次建立展延買入紀錄
-    cursor = conn.execute(
-        "INSERT INTO stock_record (batch_id, stock_code, stock_name, buy_price, shares, is_carry_over_buy) VALUES (?, ?, ?, ?, ?, 1)",
-        (new_batch_id, old_stock["stock_code"], old_stock["stock_name"], carry_price, old_stock["shares"])
-    )
-    new_record_id = cursor.lastrowid
-    
-    # 3. 把新建立的那筆 ID 寫回舊紀錄的 linked_carry_over_id 欄位中
-    conn.execute(
-        "UPDATE stock_record SET linked_carry_over_id = ? WHERE id = ?",
-        (new_record_id, record_id)
-    )
 
-    conn.commit()
-    conn.close()
+# ============ Stock Market (Suffix) Index ============
+
+def get_stock_suffixes(stock_codes):
+    """取得已解析的 Yahoo 後綴，回傳 {stock_code: suffix}"""
+    codes = list(stock_codes)
+    if not codes:
+        return {}
+    conn = get_db()
+    placeholders = ",".join("?" * len(codes))
+    rows = conn.execute(
+        f"SELECT stock_code, suffix FROM stock_market WHERE stock_code IN ({placeholders})",
+        codes
+    ).fetchall()
+    return {r["stock_code"]: r["suffix"] for r in rows}
+
+
+def save_stock_suffixes(suffixes, source):
+    """寫入代碼的 Yahoo 後綴，suffixes: {stock_code: suffix}"""
+    if not suffixes:
+        return
+    with transaction(bump=False) as conn:
+        conn.executemany(
+            """INSERT INTO stock_market (stock_code, suffix, source) VALUES (?, ?, ?)
+               ON CONFLICT(stock_code) DO UPDATE SET
+                   suffix = excluded.suffix, source = excluded.source,
+                   updated_at = datetime('now', 'localtime')""",
+            [(code, suffix, source) for code, suffix in suffixes.items()]
+        )
+
 
+# ============ Price History ============
 
-def get_all_stock_records():
-    """取得所有股票紀錄（含批次資訊），用於統計"""
+def get_history_targets():
+    """
+    需要日線的代碼與日期區間：從持有該代碼最早的批次起始日，
+    到仍有未賣出紀錄時為止 (回傳 None) 或最後一筆賣出日
+    回傳: {stock_code: (start_date, end_date 或 None)}
+    """
     conn = get_db()
     rows = conn.execute("""
-        SELECT sr.*, b.name as batch_name, b.start_date as batch_date
+        SELECT sr.stock_code,
+               MIN(b.start_date) AS start_date,
+               MAX(sr.is_sold = 0) AS has_open,
+               MAX(COALESCE(sr.sell_date, b.start_date)) AS end_date
         FROM stock_record sr
-        JOIN batch b ON sr.batch_id = b.id
-        ORDER BY b.start_date DESC, sr.id
+        JOIN batch b ON b.id = sr.batch_id
+        GROUP BY sr.stock_code
     """).fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    return {
+        r["stock_code"]: (r["start_date"], None if r["has_open"] else r["end_date"])
+        for r in rows
+    }
+
+
+def get_history_ranges(stock_codes):
+    """取得代碼已查詢過的日線區間，回傳 {stock_code: (start_date, end_date)}"""
+    stock_codes = list(stock_codes)
+    if not stock_codes:
+        return {}
+    conn = get_db()
+    placeholders = ",".join("?" * len(stock_codes))
+    rows = conn.execute(
+        f"SELECT stock_code, start_date, end_date FROM price_history_range WHERE stock_code IN ({placeholders})",
+        stock_codes
+    ).fetchall()
+    return {r["stock_code"]: (r["start_date"], r["end_date"]) for r in rows}
+
+
+def save_price_history(bars, ranges):
+    """
+    以單一交易寫入日線並擴展已查詢區間
+    bars: [(stock_code, date, open, high, low, close, volume)]
+    ranges: {stock_code: (start_date, end_date)}，與既有區間取聯集
+    """
+    with transaction() as conn:
+        conn.executemany(
+            """INSERT OR REPLACE INTO price_history (stock_code, date, open, high, low, close, volume)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            bars
+        )
+        conn.executemany(
+            """INSERT INTO price_history_range (stock_code, start_date, end_date) VALUES (?, ?, ?)
+               ON CONFLICT(stock_code) DO UPDATE SET
+                   start_date = MIN(start_date, excluded.start_date),
+                   end_date = MAX(end_date, excluded.end_date)""",
+            [(code, start, end) for code, (start, end) in ranges.items()]
+        )
+
+
+def get_close_history(stock_codes, start_date=None, end_date=None):
+    """
+    讀取多檔代碼在日期區間內的收盤價 (只取兩個欄位並以 tuple 回傳，供整欄運算)
+    回傳: {stock_code: ([date, ...], [close, ...])}，依日期排序，沒有資料的代碼不會出現
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    history = {}
+    for code in stock_codes:
+        rows = cursor.execute(
+            "SELECT date, close FROM price_history WHERE stock_code = ? AND date >= ? AND date <= ? ORDER BY date",
+            (code, start_date or "0000-00-00", end_date or "9999-12-31")
+        ).fetchall()
+        if rows:
+            dates, closes = zip(*rows)
+            history[code] = (list(dates), list(closes))
+    return history
+
+
+# ============ Refresh Job ============
+
+# 未結束的工作超過這麼久 (秒) 沒有回報進度，視為執行的 worker 已結束，標記為 failed
+REFRESH_JOB_LEASE = float(os.environ.get("REFRESH_JOB_LEASE", 300))
+
+
+def _expire_refresh_jobs(conn, now=None):
+    """把逾時未回報進度的 pending / running 工作標記為 failed，需在寫入交易內呼叫"""
+    now = time.time() if now is None else now
+    conn.execute(
+        """UPDATE refresh_job SET status = 'failed', error = ?, finished_at = datetime('now', 'localtime')
+           WHERE status IN ('pending', 'running') AND (heartbeat_at IS NULL OR heartbeat_at < ?)""",
+        ("工作逾時未回報進度 (執行的 worker 可能已結束)", now - REFRESH_JOB_LEASE)
+    )
+
+
+def create_refresh_job(trigger="manual", batch_id=None, owner=None):
+    with transaction(bump=False) as conn:
+        cursor = conn.execute(
+            "INSERT INTO refresh_job (trigger, batch_id, owner, heartbeat_at) VALUES (?, ?, ?, ?)",
+            (trigger, batch_id, owner, time.time())
+        )
+    return cursor.lastrowid
+
+
+def get_refresh_job(job_id):
+    conn = get_db()
+    row = conn.execute("SELECT * FROM refresh_job WHERE id = ?", (job_id,)).fetchone()
+    if row and row["status"] in ("pending", "running") and (row["heartbeat_at"] or 0) < time.time() - REFRESH_JOB_LEASE:
+        with transaction(bump=False):
+            _expire_refresh_jobs(conn)
+        row = conn.execute("SELECT * FROM refresh_job WHERE id = ?", (job_id,)).fetchone()
+    if not row:
+        return None
+    job = dict(row)
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+def find_active_refresh_job(batch_id=None):
+    """找出同範圍內尚未結束的工作，避免重複排入；逾時未回報進度的工作先標記為 failed"""
+    with transaction(bump=False) as conn:
+        _expire_refresh_jobs(conn)
+        row = conn.execute(
+            "SELECT id FROM refresh_job WHERE status IN ('pending', 'running') AND batch_id IS ? ORDER BY id DESC LIMIT 1",
+            (batch_id,)
+        ).fetchone()
+    return row["id"] if row else None
+
+
+def start_refresh_job(job_id, total):
+    with transaction(bump=False) as conn:
+        conn.execute(
+            """UPDATE refresh_job SET status = 'running', total = ?, started_at = datetime('now', 'localtime'),
+               heartbeat_at = ? WHERE id = ?""",
+            (total, time.time(), job_id)
+        )
+
+
+def update_refresh_job_progress(job_id, done):
+    with transaction(bump=False) as conn:
+        conn.execute("UPDATE refresh_job SET done = ?, heartbeat_at = ? WHERE id = ?", (done, time.time(), job_id))
+
+
+def finish_refresh_job(job_id, updated=0, result=None, error=None):
+    """結束工作：有 error 時標記為 failed"""
+    with transaction(bump=False) as conn:
+        conn.execute(
+            """UPDATE refresh_job SET status = ?, done = total, updated = ?, result = ?, error = ?,
+               finished_at = datetime('now', 'localtime') WHERE id = ?""",
+            ("failed" if error else "done", updated,
+             json.dumps(result, ensure_ascii=False) if result is not None else None, error, job_id)
+        )
+
+
+def acquire_lease(name, owner, now, ttl):
+    """取得或續約跨 worker 的租約，成功回傳 True"""
+    with transaction(bump=False) as conn:
+        row = conn.execute("SELECT owner, expires_at FROM scheduler_lease WHERE name = ?", (name,)).fetchone()
+        acquired = row is None or row["owner"] == owner or row["expires_at"] < now
+        if acquired:
+            conn.execute(
+                """INSERT INTO scheduler_lease (name, owner, expires_at) VALUES (?, ?, ?)
+                   ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at""",
+                (name, owner, now + ttl)
+            )
+    return acquired
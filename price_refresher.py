@@ -0,0 +1,162 @@
+"""
+背景股價更新 - 在 app 行程內以執行緒更新未賣出持股的現價
+工作狀態存放在 SQLite (refresh_job)，任一 gunicorn worker 都能查詢進度
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from models import (
+    get_open_stock_records, update_stock_current_prices,
+    create_refresh_job, find_active_refresh_job, start_refresh_job,
+    update_refresh_job_progress, finish_refresh_job, acquire_lease, release_db
+)
+from stock_service import (
+    get_stock_prices, is_market_open, backfill_price_history, last_closed_session_date
+)
+
+logger = logging.getLogger(__name__)
+
+# 定時更新間隔 (秒)，設為 0 則停用排程，只保留手動觸發
+REFRESH_INTERVAL = float(os.environ.get("PRICE_REFRESH_INTERVAL", 300))
+# 每次向上游批次抓取的代碼數，同時也是進度回報的粒度
+REFRESH_CHUNK_SIZE = int(os.environ.get("PRICE_REFRESH_CHUNK_SIZE", 50))
+
+SCHEDULER_LEASE = "price-refresh"
+HISTORY_LEASE = "price-history"
+_owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+_scheduler_started = False
+_scheduler_lock = threading.Lock()
+# 本 worker 已補抓到的交易日，同一天不重複嘗試
+_history_day = None
+_backfill_running = False
+
+
+def run_refresh_job(job_id, batch_id=None):
+    """執行一個更新工作：分批抓價，最後以單一交易寫回所有現價"""
+    try:
+        stocks = get_open_stock_records(batch_id)
+        codes = list(dict.fromkeys(s["stock_code"] for s in stocks))
+        start_refresh_job(job_id, len(codes))
+
+        prices = {}
+        for i in range(0, len(codes), REFRESH_CHUNK_SIZE):
+            prices.update(get_stock_prices(codes[i:i + REFRESH_CHUNK_SIZE]))
+            update_refresh_job_progress(job_id, min(i + REFRESH_CHUNK_SIZE, len(codes)))
+
+        updates = {}
+        updated = []
+        for stock in stocks:
+            price, success = prices.get(stock["stock_code"], (0.0, False))
+            if success:
+                updates[stock["id"]] = price
+                updated.append({
+                    "id": stock["id"],
+                    "stock_code": stock["stock_code"],
+                    "current_price": price
+                })
+        update_stock_current_prices(updates)
+
+        failed = [code for code in codes if not prices.get(code, (0.0, False))[1]]
+        finish_refresh_job(job_id, len(updated), {"updated": updated, "failed": failed})
+        logger.info(f"股價更新工作 #{job_id} 完成：{len(updated)} 筆更新，{len(failed)} 檔失敗")
+    except Exception as e:
+        logger.error(f"股價更新工作 #{job_id} 失敗: {e}", exc_info=True)
+        finish_refresh_job(job_id, error=str(e))
+    finally:
+        release_db()
+
+
+def submit_refresh_job(batch_id=None, trigger="manual"):
+    """
+    排入一個背景更新工作並立即回傳工作 ID
+    同範圍已有進行中的工作時直接回傳該工作，不重複抓取
+    """
+    job_id = find_active_refresh_job(batch_id)
+    if job_id:
+        return job_id
+    job_id = create_refresh_job(trigger, batch_id, _owner)
+    threading.Thread(
+        target=run_refresh_job, args=(job_id, batch_id),
+        name=f"refresh-job-{job_id}", daemon=True
+    ).start()
+    return job_id
+
+
+def _run_history_backfill(targets=None):
+    global _backfill_running
+    try:
+        backfill_price_history(targets)
+    except Exception as e:
+        logger.error(f"日線補抓失敗: {e}", exc_info=True)
+    finally:
+        with _scheduler_lock:
+            _backfill_running = False
+        release_db()
+
+
+def submit_history_backfill(targets=None):
+    """
+    在背景補抓日線，回傳是否有啟動新的補抓 (本 worker 已有補抓在執行時不重複啟動)
+    targets: {stock_code: (start_date, end_date 或 None)}，預設為所有持有過的代碼
+    """
+    global _backfill_running
+    with _scheduler_lock:
+        if _backfill_running:
+            return False
+        _backfill_running = True
+    threading.Thread(
+        target=_run_history_backfill, args=(targets,), name="history-backfill", daemon=True
+    ).start()
+    return True
+
+
+def _append_history(now):
+    """每個交易日收盤後補抓一次日線 (只由持有租約的 worker 執行，補抓本身只抓缺少的日期)"""
+    global _history_day
+    day = last_closed_session_date(now)
+    if day == _history_day:
+        return
+    try:
+        if not acquire_lease(HISTORY_LEASE, _owner, now, REFRESH_INTERVAL * 1.5):
+            return
+        result = backfill_price_history(now=now)
+        # 有失敗的代碼時留待下一個週期重試
+        if not result["failed"]:
+            _history_day = day
+    except Exception as e:
+        logger.error(f"日線補抓失敗: {e}", exc_info=True)
+
+
+def _scheduler_loop():
+    while True:
+        time.sleep(REFRESH_INTERVAL)
+        try:
+            now = time.time()
+            _append_history(now)
+            if not is_market_open(now):
+                continue
+            # 持有租約的 worker 每個週期續約一次，其他 worker 只在租約過期後接手
+            if not acquire_lease(SCHEDULER_LEASE, _owner, now, REFRESH_INTERVAL * 1.5):
+                continue
+            if find_active_refresh_job():
+                continue
+            run_refresh_job(create_refresh_job("schedule"))
+        except Exception as e:
+            logger.error(f"定時股價更新失敗: {e}", exc_info=True)
+        finally:
+            release_db()
+
+
+def start_scheduler():
+    """啟動定時更新執行緒 (每個 worker 只會啟動一次)"""
+    global _scheduler_started
+    if REFRESH_INTERVAL <= 0:
+        return
+    with _scheduler_lock:
+        if _scheduler_started:
+            return
+        _scheduler_started = True
+    threading.Thread(target=_scheduler_loop, name="price-refresh-scheduler", daemon=True).start()
+    logger.info(f"背景股價更新已啟動，間隔 {REFRESH_INTERVAL:.0f} 秒")
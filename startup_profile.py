@@ -0,0 +1,36 @@
+"""
+啟動量測 - 設定 STARTUP_PROFILE=1 時，記錄每個 worker 載入模組花費的時間與記憶體
+"""
+import logging
+import os
+import resource
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get("STARTUP_PROFILE", "").lower() in ("1", "true", "yes")
+# 會明顯拖慢啟動的套件，回報時列出目前已載入的有哪些
+HEAVY_MODULES = ("numpy", "pandas", "yfinance", "twstock")
+
+
+def rss_mb():
+    """目前行程的 RSS (MB)；沒有 /proc 的平台改回報峰值 RSS"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 的 ru_maxrss 單位是 bytes，Linux 是 KiB
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def report(label, started):
+    """記錄從 started (time.perf_counter()) 到現在的耗時、目前 RSS 與已載入的重量級套件"""
+    if not ENABLED:
+        return
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    logger.info(
+        f"[startup] pid={os.getpid()} {label}: {(time.perf_counter() - started) * 1000:.0f} ms, "
+        f"RSS {rss_mb():.1f} MB, 已載入: {', '.join(loaded) or '無'}"
+    )
@@ -47,13 +47,125 @@ function escHtml(str) {
 
 document.addEventListener("DOMContentLoaded", () => {
     loadSummary();
+    startPriceStream();
 });
 
 // ============ Summary / Stats ============
 
+// 上次繪製的摘要版本 (ETag)
+let _summaryEtag = null;
+
+// 本地資料：批次彙總與已載入明細的股票紀錄，version 為資料版本，供 /api/changes 增量同步
+// nextCursor 為批次列表下一頁的游標 (沒有下一頁時為 null)
+const _store = { version: 0, batches: new Map(), stocks: new Map(), nextCursor: null };
+
+// 批次列表每頁筆數
+const BATCH_PAGE_SIZE = 20;
+
 async function loadSummary() {
-    const data = await api("/api/summary");
+    // 瀏覽器會帶 If-None-Match 向伺服器確認版本；資料未變動時不重新繪製
+    const res = await fetch(`/api/summary?limit=${BATCH_PAGE_SIZE}`);
+    const etag = res.headers.get("ETag");
+    if (etag && etag === _summaryEtag) return;
+    const data = await res.json();
+    _summaryEtag = etag;
+    _store.version = etag ? parseInt(etag.replace(/\D/g, "")) || 0 : 0;
+    _store.batches = new Map(data.batches.map(b => [b.id, b]));
+    _store.nextCursor = data.next_cursor;
+    renderStatCards(data);
+    renderBatchList(data.batches);
+}
+
+async function loadMoreBatches() {
+    // 以游標接續讀取下一頁批次，附加在列表後方
+    if (!_store.nextCursor) return;
+    const data = await api(`/api/summary?limit=${BATCH_PAGE_SIZE}&cursor=${encodeURIComponent(_store.nextCursor)}`);
+    // 已在列表中的批次 (例如同步時已加入) 不重複附加
+    const added = data.batches.filter(b => !_store.batches.has(b.id));
+    for (const b of added) _store.batches.set(b.id, b);
+    _store.nextCursor = data.next_cursor;
+    document.getElementById("loadMoreBatches")?.remove();
+    document.getElementById("batchList").insertAdjacentHTML("beforeend", added.map(batchCardHtml).join("") + loadMoreHtml());
+}
+
+function isBeyondLoadedPage(b) {
+    // 還有下一頁時，排序在已載入最後一筆 (start_date, id) 之後的批次屬於尚未載入的頁面
+    if (!_store.nextCursor) return false;
+    const cut = _store.nextCursor.lastIndexOf(",");
+    const date = _store.nextCursor.slice(0, cut);
+    const id = Number(_store.nextCursor.slice(cut + 1));
+    return b.start_date < date || (b.start_date === date && b.id < id);
+}
+
+function loadMoreHtml() {
+    if (!_store.nextCursor) return "";
+    return `<div id="loadMoreBatches" style="text-align:center; padding:12px;">
+        <button class="btn btn-secondary btn-sm" onclick="loadMoreBatches()">載入更多</button>
+    </div>`;
+}
+
+async function syncChanges() {
+    // 只取回上次同步後異動的批次與股票紀錄，就地更新受影響的卡片與明細
+    const data = await api(`/api/changes?since=${_store.version}`);
+    if (data.full) {
+        _summaryEtag = null;
+        return loadSummary();
+    }
+
+    const touched = new Set();
+    for (const id of data.deleted.batches) {
+        _store.batches.delete(id);
+        document.getElementById(`batch-${id}`)?.remove();
+    }
+    for (const id of data.deleted.stocks) {
+        const old = _store.stocks.get(id);
+        if (old) touched.add(old.batch_id);
+        _store.stocks.delete(id);
+    }
+    for (const s of data.stocks) {
+        const old = _store.stocks.get(s.id);
+        if (old) touched.add(old.batch_id);
+        _store.stocks.set(s.id, s);
+        touched.add(s.batch_id);
+    }
+
+    let listChanged = false;
+    const visible = [];
+    for (const b of data.batches) {
+        const old = _store.batches.get(b.id);
+        if (isBeyondLoadedPage(b)) {
+            // 尚未載入的頁面留給「載入更多」讀取；原本在列表中但日期移到後面頁面的批次也一併移除
+            if (old) {
+                _store.batches.delete(b.id);
+                listChanged = true;
+            }
+            continue;
+        }
+        if (!old || old.start_date !== b.start_date) listChanged = true;
+        _store.batches.set(b.id, b);
+        visible.push(b);
+    }
+    _store.version = data.version;
+
+    renderStatCards(data.totals);
+    if (listChanged || _store.batches.size === 0) {
+        // 新增批次或日期改變會影響排序，改以本地資料重繪整個列表
+        renderBatchList(sortedStoreBatches());
+        return;
+    }
+    for (const b of visible) replaceBatchCard(b);
+    for (const batchId of touched) {
+        const card = document.getElementById(`batch-${batchId}`);
+        if (card && card.classList.contains("expanded")) renderBatchDetail(batchId);
+    }
+}
+
+function sortedStoreBatches() {
+    return [..._store.batches.values()].sort((a, b) =>
+        a.start_date === b.start_date ? b.id - a.id : (a.start_date < b.start_date ? 1 : -1));
+}
 
+function renderStatCards(data) {
     document.getElementById("statTotalInvested").textContent = `$${fmt(data.total_invested)}`;
     document.getElementById("statMarketValue").textContent = `$${fmt(data.total_market_value)}`;
 
@@ -67,8 +179,49 @@ async function loadSummary() {
     const pctEl = document.getElementById("statPnlPct");
     pctEl.textContent = `${pnlSign(data.total_pnl_pct)}${fmtDecimal(data.total_pnl_pct)}%`;
     pctEl.className = `stat-value ${pnlClass(data.total_pnl_pct)}`;
+}
 
-    renderBatchList(data.batches);
+// ============ Live Price Stream ============
+
+function formatPnl(pnl, pnlPct) {
+    return `${pnlSign(pnl)}$${fmt(Math.abs(pnl))} (${pnlSign(pnlPct)}${fmtDecimal(pnlPct)}%)`;
+}
+
+function startPriceStream() {
+    if (!window.EventSource) return;
+    // 連線中斷或伺服器結束串流後，EventSource 會依 retry 設定自動重連
+    const source = new EventSource("/api/stream/prices");
+    source.addEventListener("prices", e => applyPriceUpdate(JSON.parse(e.data)));
+}
+
+function applyPriceUpdate(update) {
+    // 只修改受影響的儲存格與統計卡片，不重新繪製批次列表
+    for (const c of update.changes) {
+        const row = document.querySelector(`tr[data-record-id="${c.record_id}"]`);
+        if (!row) continue;
+        row.querySelector(".cell-price").textContent = c.current_price ? "$" + fmtDecimal(c.current_price) : "—";
+        row.querySelector(".cell-fees").textContent = `$${fmt(c.total_fees)}`;
+        const pnlEl = row.querySelector(".cell-pnl");
+        pnlEl.textContent = formatPnl(c.net_pnl, c.net_pnl_pct);
+        pnlEl.className = `cell-pnl pnl-${pnlClass(c.net_pnl) || 'zero'}`;
+    }
+
+    for (const b of update.batches) {
+        const headerEl = document.getElementById(`batch-pnl-${b.id}`);
+        if (headerEl) {
+            headerEl.textContent = formatPnl(b.pnl, b.pnl_pct);
+            headerEl.className = `batch-pnl ${pnlClass(b.pnl)}`;
+        }
+        const totalRow = document.querySelector(`tr[data-batch-total="${b.id}"]`);
+        if (totalRow) {
+            totalRow.querySelector(".cell-fees").textContent = `$${fmt(b.total_fees)}`;
+            const pnlEl = totalRow.querySelector(".cell-pnl");
+            pnlEl.textContent = formatPnl(b.pnl, b.pnl_pct);
+            pnlEl.className = `cell-pnl pnl-${pnlClass(b.pnl) || 'zero'}`;
+        }
+    }
+
+    renderStatCards(update.totals);
 }
 
 // ============ Batch List ============
@@ -82,52 +235,66 @@ function renderBatchList(batches) {
         return;
     }
 
-    container.innerHTML = batches.map(b => {
-        const pnlCls = pnlClass(b.pnl);
-        const pnlText = `${pnlSign(b.pnl)}$${fmt(Math.abs(b.pnl))} (${pnlSign(b.pnl_pct)}${fmtDecimal(b.pnl_pct)}%)`;
-        
-        let headerBadge = '';
-        let reportHtml = '';
-        let cardStyle = '';
+    container.innerHTML = batches.map(batchCardHtml).join("") + loadMoreHtml();
+}
 
-        if (b.is_closed && b.stock_count > 0) {
-            headerBadge = `<span style="font-size: 0.75rem; background: var(--success); color: white; padding: 2px 6px; border-radius: 4px; margin-left: 8px;">✅ 已結算</span>`;
-            cardStyle = 'border-left: 4px solid var(--success);';
-            
-            const winRate = b.stock_count > 0 ? Math.round((b.win_count / b.stock_count) * 100) : 0;
-            const bestText = b.best_stock ? `${b.best_stock.stock_code} ${b.best_stock.stock_name} (${pnlSign(b.best_stock.pnl_pct)}${fmtDecimal(b.best_stock.pnl_pct)}%)` : '無';
-            const worstText = b.worst_stock ? `${b.worst_stock.stock_code} ${b.worst_stock.stock_name} (${pnlSign(b.worst_stock.pnl_pct)}${fmtDecimal(b.worst_stock.pnl_pct)}%)` : '無';
-
-            reportHtml = `
-            <div style="background: var(--bg-hover); padding: 12px 15px; border-top: 1px solid var(--border); font-size: 0.9em; display: flex; flex-direction: column; gap: 6px;">
-                <div style="display: flex; align-items: center; justify-content: space-between;">
-                    <strong>🏆 結算戰報</strong>
-                    <span class="${pnlCls}" style="font-weight: bold;">淨損益：${pnlText}</span>
-                </div>
-                <div style="display: flex; justify-content: space-between; flex-wrap: wrap; gap: 10px; margin-top: 4px;">
-                    <span>🎯 勝率：${b.win_count} 勝 ${b.loss_count} 敗 (${winRate}%)</span>
-                    <span>🚀 最強標的：<span class="text-success">${bestText}</span></span>
-                    <span>📉 拖油瓶：<span class="text-danger">${worstText}</span></span>
-                </div>
-            </div>`;
-        }
+function batchCardHtml(b) {
+    const pnlCls = pnlClass(b.pnl);
+    const pnlText = `${pnlSign(b.pnl)}$${fmt(Math.abs(b.pnl))} (${pnlSign(b.pnl_pct)}${fmtDecimal(b.pnl_pct)}%)`;
+    
+    let headerBadge = '';
+    let reportHtml = '';
+    let cardStyle = '';
 
-        return `
-        <div class="batch-card" id="batch-${b.id}" style="${cardStyle}">
-            <div class="batch-card-header" onclick="toggleBatch(${b.id})">
-                <div class="batch-info">
-                    <span class="batch-name">${escHtml(b.name)}${headerBadge}</span>
-                    <span class="batch-date">${b.start_date} · ${b.stock_count} 檔 · 投入 $${fmt(b.total_cost)}</span>
-                </div>
-                <!-- 展開時箭頭動畫可在此實作 -->
-                ${!b.is_closed ? `<span class="batch-pnl ${pnlCls}">${pnlText}</span>` : ''}
+    if (b.is_closed && b.stock_count > 0) {
+        headerBadge = `<span style="font-size: 0.75rem; background: var(--success); color: white; padding: 2px 6px; border-radius: 4px; margin-left: 8px;">✅ 已結算</span>`;
+        cardStyle = 'border-left: 4px solid var(--success);';
+        
+        const winRate = b.stock_count > 0 ? Math.round((b.win_count / b.stock_count) * 100) : 0;
+        const bestText = b.best_stock ? `${b.best_stock.stock_code} ${b.best_stock.stock_name} (${pnlSign(b.best_stock.pnl_pct)}${fmtDecimal(b.best_stock.pnl_pct)}%)` : '無';
+        const worstText = b.worst_stock ? `${b.worst_stock.stock_code} ${b.worst_stock.stock_name} (${pnlSign(b.worst_stock.pnl_pct)}${fmtDecimal(b.worst_stock.pnl_pct)}%)` : '無';
+
+        reportHtml = `
+        <div style="background: var(--bg-hover); padding: 12px 15px; border-top: 1px solid var(--border); font-size: 0.9em; display: flex; flex-direction: column; gap: 6px;">
+            <div style="display: flex; align-items: center; justify-content: space-between;">
+                <strong>🏆 結算戰報</strong>
+                <span class="${pnlCls}" style="font-weight: bold;">淨損益：${pnlText}</span>
             </div>
-            ${reportHtml}
-            <div class="batch-card-body" id="batch-body-${b.id}">
-                <div style="text-align:center; padding:20px; color:var(--text-muted);">載入中...</div>
+            <div style="display: flex; justify-content: space-between; flex-wrap: wrap; gap: 10px; margin-top: 4px;">
+                <span>🎯 勝率：${b.win_count} 勝 ${b.loss_count} 敗 (${winRate}%)</span>
+                <span>🚀 最強標的：<span class="text-success">${bestText}</span></span>
+                <span>📉 拖油瓶：<span class="text-danger">${worstText}</span></span>
             </div>
         </div>`;
-    }).join("");
+    }
+
+    return `
+    <div class="batch-card" id="batch-${b.id}" style="${cardStyle}">
+        <div class="batch-card-header" onclick="toggleBatch(${b.id})">
+            <div class="batch-info">
+                <span class="batch-name">${escHtml(b.name)}${headerBadge}</span>
+                <span class="batch-date">${b.start_date} · ${b.stock_count} 檔 · 投入 $${fmt(b.total_cost)}</span>
+            </div>
+            <!-- 展開時箭頭動畫可在此實作 -->
+            ${!b.is_closed ? `<span class="batch-pnl ${pnlCls}" id="batch-pnl-${b.id}">${pnlText}</span>` : ''}
+        </div>
+        ${reportHtml}
+        <div class="batch-card-body" id="batch-body-${b.id}">
+            <div style="text-align:center; padding:20px; color:var(--text-muted);">載入中...</div>
+        </div>
+    </div>`;
+}
+
+function replaceBatchCard(b) {
+    // 換掉卡片表頭與戰報，保留展開狀態與已繪製的明細
+    const card = document.getElementById(`batch-${b.id}`);
+    if (!card) return;
+    const expanded = card.classList.contains("expanded");
+    const body = card.querySelector(".batch-card-body");
+    card.outerHTML = batchCardHtml(b);
+    const fresh = document.getElementById(`batch-${b.id}`);
+    if (expanded) fresh.classList.add("expanded");
+    fresh.querySelector(".batch-card-body").replaceWith(body);
 }
 
 function createEmptyState() {
@@ -160,7 +327,16 @@ async function loadBatchDetail(batchId) {
     body.innerHTML = `<div style="text-align:center; padding:20px; color:var(--text-muted);"><span class="spinner"></span> 載入中...</div>`;
 
     const batch = await api(`/api/batches/${batchId}`);
-    const stocks = batch.stocks || [];
+    for (const [id, s] of _store.stocks) {
+        if (s.batch_id === batchId) _store.stocks.delete(id);
+    }
+    for (const s of batch.stocks || []) _store.stocks.set(s.id, s);
+    renderBatchDetail(batchId);
+}
+
+function renderBatchDetail(batchId) {
+    const body = document.getElementById(`batch-body-${batchId}`);
+    const stocks = [..._store.stocks.values()].filter(s => s.batch_id === batchId).sort((a, b) => a.id - b.id);
 
     if (stocks.length === 0) {
         body.innerHTML = `<p class="text-muted text-sm" style="padding:16px 0;">尚無股票紀錄</p>`;
@@ -202,15 +378,15 @@ async function loadBatchDetail(batchId) {
 
             const rowStyle = isSold ? 'opacity:0.7;' : '';
 
-            return `<tr style="${rowStyle}">
+            return `<tr style="${rowStyle}" data-record-id="${s.id}">
                 <td><strong>${escHtml(s.stock_code)}</strong></td>
                 <td>${escHtml(s.stock_name)}</td>
                 <td>$${fmtDecimal(s.buy_price)}</td>
                 <td>${fmt(s.shares)}</td>
-                <td>${priceDisplay}</td>
+                <td class="cell-price">${priceDisplay}</td>
                 <td>$${fmt(cost)}</td>
-                <td style="color:var(--warning);">$${fmt(fees)}</td>
-                <td class="pnl-${cls || 'zero'}">${pnlSign(pnl)}$${fmt(Math.abs(pnl))} (${pnlSign(pnlPct)}${fmtDecimal(pnlPct)}%)</td>
+                <td class="cell-fees" style="color:var(--warning);">$${fmt(fees)}</td>
+                <td class="cell-pnl pnl-${cls || 'zero'}">${pnlSign(pnl)}$${fmt(Math.abs(pnl))} (${pnlSign(pnlPct)}${fmtDecimal(pnlPct)}%)</td>
                 <td>${soldBadge}</td>
                 <td>${actionBtn}</td>
             </tr>`;
@@ -238,11 +414,11 @@ async function loadBatchDetail(batchId) {
                 </thead>
                 <tbody>
                     ${rows}
-                    <tr style="border-top:2px solid var(--border-color); font-weight:700;">
+                    <tr style="border-top:2px solid var(--border-color); font-weight:700;" data-batch-total="${batchId}">
                         <td colspan="5" style="text-align:right;">合計</td>
                         <td>$${fmt(totalCost)}</td>
-                        <td style="color:var(--warning);">$${fmt(totalFees)}</td>
-                        <td class="pnl-${totalCls || 'zero'}">${pnlSign(totalPnl)}$${fmt(Math.abs(totalPnl))} (${pnlSign(totalPnlPct)}${fmtDecimal(totalPnlPct)}%)</td>
+                        <td class="cell-fees" style="color:var(--warning);">$${fmt(totalFees)}</td>
+                        <td class="cell-pnl pnl-${totalCls || 'zero'}">${pnlSign(totalPnl)}$${fmt(Math.abs(totalPnl))} (${pnlSign(totalPnlPct)}${fmtDecimal(totalPnlPct)}%)</td>
                         <td colspan="2"></td>
                     </tr>
                 </tbody>
@@ -292,16 +468,14 @@ async function confirmSellStock() {
     });
     closeSellModal();
     showToast("已記錄賣出！");
-    await loadBatchDetail(parseInt(batchId));
-    loadSummary();
+    await syncChanges();
 }
 
 async function unsellStock(recordId, batchId) {
     showConfirm("確定要取消此筆賣出紀錄？", async () => {
         await api(`/api/stocks/${recordId}/unsell`, { method: "POST" });
         showToast("已取消賣出");
-        await loadBatchDetail(batchId);
-        loadSummary();
+        await syncChanges();
     });
 }
 
@@ -378,9 +552,8 @@ async function confirmMoveStock() {
         closeMoveModal();
         showToast("✅ 已成功將標的展延至新批次！");
         
-        // 更新當前舊批次與整體統計表
-        await loadBatchDetail(parseInt(oldBatchId));
-        loadSummary();
+        // 只同步受影響的舊批次、新批次與整體統計
+        await syncChanges();
     } catch (e) {
         showToast("展延時發生錯誤", "error");
     }
@@ -409,19 +582,51 @@ async function executeConfirmAction() {
 
 // ============ Refresh Prices ============
 
+// 排入背景更新工作後輪詢進度，不佔住畫面等待上游回應
+// 等待更新工作結束的上限 (毫秒)，逾時或查詢失敗時視為失敗，不再輪詢
+const REFRESH_JOB_TIMEOUT = 5 * 60 * 1000;
+
+async function runRefreshJob(batchId = null) {
+    try {
+        const { job_id, error } = await api("/api/refresh-jobs", {
+            method: "POST",
+            body: JSON.stringify({ batch_id: batchId })
+        });
+        if (!job_id) return { status: "failed", error: error || "無法建立更新工作" };
+
+        const deadline = Date.now() + REFRESH_JOB_TIMEOUT;
+        while (Date.now() < deadline) {
+            await new Promise(r => setTimeout(r, 1000));
+            const job = await api(`/api/refresh-jobs/${job_id}`);
+            if (!job || job.error && !job.status) return { status: "failed", error: job && job.error };
+            if (job.status === "done" || job.status === "failed") return job;
+        }
+        return { status: "failed", error: "等待更新逾時" };
+    } catch (e) {
+        return { status: "failed", error: String(e) };
+    }
+}
+
 async function refreshBatchPrices(batchId) {
     showToast("正在更新股價...");
-    await api(`/api/refresh-prices/${batchId}`, { method: "POST" });
+    const job = await runRefreshJob(batchId);
+    if (job.status === "failed") {
+        showToast("股價更新失敗", "error");
+        return;
+    }
     showToast("股價已更新！");
-    await loadBatchDetail(batchId);
-    loadSummary();
+    await syncChanges();
 }
 
 async function refreshAllPrices() {
-    showToast("正在更新所有股價，這可能需要一些時間...");
-    const result = await api("/api/refresh-all-prices", { method: "POST" });
-    showToast(`已更新 ${result.total_updated} 檔股票的股價`);
-    loadSummary();
+    showToast("已在背景更新所有股價，完成後會自動刷新畫面");
+    const job = await runRefreshJob();
+    if (job.status === "failed") {
+        showToast("股價更新失敗", "error");
+        return;
+    }
+    showToast(`已更新 ${job.updated} 檔股票的股價`);
+    syncChanges();
 }
 
 // ============ Batch Modal ============
@@ -485,7 +690,7 @@ function addStockRow(code = "", name = "", price = "", shares = "", recordId = "
     row.className = "stock-input-row";
     row.dataset.recordId = recordId;
     row.innerHTML = `
-        <input type="text" class="stock-code-input" placeholder="代碼" value="${escHtml(String(code))}" onblur="lookupStockName(this)">
+        <input type="text" class="stock-code-input" placeholder="代碼或名稱" value="${escHtml(String(code))}" list="stockSuggestions" autocomplete="off" oninput="suggestStocks(this)" onblur="lookupStockName(this)">
         <span class="stock-name-label">${name || "—"}</span>
         <input type="number" class="stock-price-input" placeholder="買入價" value="${price}" step="0.01">
         <input type="number" class="stock-shares-input" placeholder="股數" value="${shares}">
@@ -599,16 +804,55 @@ function parseImportText() {
     }
 }
 
+// 代碼 / 名稱自動完成：停止輸入一小段時間後才查詢，只查本機索引、不抓股價
+const STOCK_SEARCH_DELAY = 150;
+let _stockSearchTimer = null;
+const _stockNameCache = {};
+
+function searchStocks(q) {
+    return api(`/api/stocks/search?q=${encodeURIComponent(q)}`).then(data => {
+        (data.results || []).forEach(r => { _stockNameCache[r.code] = r.name; });
+        return data.results || [];
+    });
+}
+
+function suggestStocks(input) {
+    clearTimeout(_stockSearchTimer);
+    const q = input.value.trim();
+    if (!q) return;
+    _stockSearchTimer = setTimeout(async () => {
+        try {
+            const results = await searchStocks(q);
+            if (input.value.trim() !== q) return;  // 已經有更新的輸入
+            document.getElementById("stockSuggestions").innerHTML = results
+                .map(r => `<option value="${escHtml(r.code)}">${escHtml(r.code)} ${escHtml(r.name)}</option>`)
+                .join("");
+        } catch {
+            // 建議清單失敗不影響手動輸入
+        }
+    }, STOCK_SEARCH_DELAY);
+}
+
 async function lookupStockName(input) {
     const code = input.value.trim();
     if (!code) return;
 
     const nameLabel = input.parentElement.querySelector(".stock-name-label");
+    if (_stockNameCache[code]) {
+        nameLabel.textContent = _stockNameCache[code];
+        return;
+    }
     nameLabel.textContent = "查詢中...";
 
     try {
-        const info = await api(`/api/stock-info/${code}`);
-        nameLabel.textContent = info.name || "未知";
+        const results = await searchStocks(code);
+        let match = results.find(r => r.code === code);
+        // 輸入的是名稱且只對到一檔時，直接換成該檔代碼
+        if (!match && results.length === 1) {
+            match = results[0];
+            input.value = match.code;
+        }
+        nameLabel.textContent = match ? match.name : "未知";
     } catch {
         nameLabel.textContent = "查詢失敗";
     }
@@ -626,60 +870,37 @@ async function saveBatch() {
     const stocks = [];
     for (const row of rows) {
         const code = row.querySelector(".stock-code-input").value.trim();
-        const stockName = row.querySelector(".stock-name-label").textContent;
+        const label = row.querySelector(".stock-name-label").textContent;
         const buyPrice = parseFloat(row.querySelector(".stock-price-input").value) || 0;
         const sharesVal = parseInt(row.querySelector(".stock-shares-input").value) || 0;
         const recordId = row.dataset.recordId;
+        // 尚未查到名稱的列交給後端批次查詢
+        const stockName = ["—", "查詢中...", "查詢失敗"].includes(label) ? "" : label;
 
         if (code) {
-            stocks.push({ code, name: stockName, buy_price: buyPrice, shares: sharesVal, record_id: recordId });
+            stocks.push({ stock_code: code, stock_name: stockName, buy_price: buyPrice, shares: sharesVal, record_id: recordId || null });
         }
     }
 
     try {
-        let batchId;
-
-        if (editId) {
-            await api(`/api/batches/${editId}`, {
-                method: "PUT",
-                body: JSON.stringify({ name, start_date: date, allocated_capital: 0 })
-            });
-            batchId = editId;
-
-            for (const s of stocks) {
-                if (s.record_id) {
-                    await api(`/api/stocks/${s.record_id}`, {
-                        method: "PUT",
-                        body: JSON.stringify({ buy_price: s.buy_price, shares: s.shares })
-                    });
-                } else {
-                    await api(`/api/batches/${batchId}/stocks`, {
-                        method: "POST",
-                        body: JSON.stringify({ stock_code: s.code, stock_name: s.name, buy_price: s.buy_price, shares: s.shares })
-                    });
-                }
-            }
-        } else {
-            const result = await api("/api/batches", {
-                method: "POST",
-                body: JSON.stringify({ name, start_date: date, allocated_capital: 0 })
-            });
-            batchId = result.batch_id;
-
-            for (const s of stocks) {
-                await api(`/api/batches/${batchId}/stocks`, {
-                    method: "POST",
-                    body: JSON.stringify({ stock_code: s.code, stock_name: s.name, buy_price: s.buy_price, shares: s.shares })
-                });
-            }
-        }
-
-        showToast("批次已儲存，正在抓取最新股價...");
-        await api(`/api/refresh-prices/${batchId}`, { method: "POST" });
+        // 批次表頭與所有股票一次送出，由後端以單一交易寫入
+        const payload = JSON.stringify({ name, start_date: date, allocated_capital: 0, stocks });
+        const result = editId
+            ? await api(`/api/batches/${editId}/full`, { method: "PUT", body: payload })
+            : await api("/api/batches/full", { method: "POST", body: payload });
+        if (result.error) throw new Error(result.error);
+        const batchId = result.batch_id;
 
         closeBatchModal();
-        showToast("儲存完成！股價已更新。");
+        showToast("批次已儲存，正在背景抓取最新股價...");
         loadSummary();
+
+        runRefreshJob(batchId).then(job => {
+            if (job.status === "done") {
+                showToast("股價已更新。");
+                loadSummary();
+            }
+        });
     } catch (err) {
         showToast("儲存失敗：" + err.message, "error");
     }
@@ -728,6 +949,8 @@ async function runCalculation() {
 
     // 支持空白、逗號分隔
     const stocks = stocksInput.split(/[\s,，]+/).filter(s => s);
+    const mode = document.getElementById("calcMode").value;
+    const tolerance = (parseFloat(document.getElementById("calcTolerance").value) || 0) / 100;
 
     const resultDiv = document.getElementById("calcResult");
     resultDiv.innerHTML = `<div style="text-align:center; padding:16px; color:var(--text-muted);"><span class="spinner"></span> 正在查詢股價並試算...</div>`;
@@ -736,7 +959,7 @@ async function runCalculation() {
     try {
         const data = await api("/api/calculate", {
             method: "POST",
-            body: JSON.stringify({ budget, stocks })
+            body: JSON.stringify({ budget, stocks, mode, tolerance })
         });
 
         if (data.error) {
@@ -762,6 +985,9 @@ async function runCalculation() {
         resultDiv.innerHTML = `
             <div class="text-muted text-sm mb-2" style="margin-bottom:8px;">
                 預算 $${fmt(data.budget)} ÷ ${data.num_stocks} 檔 = 每檔分配 $${fmt(data.allocated_per_stock)}
+                ${data.mode === "optimize" ? `· 盡量用完預算 (每檔最多 +${fmt(data.tolerance * 100)}%)` : ""}
+                · 抓價 ${fmt(data.quote_wait_ms || 0)} ms
+                ${data.timed_out && data.timed_out.length ? `· <span style="color:var(--warning);">逾時：${escHtml(data.timed_out.join(" "))}</span>` : ""}
             </div>
             <table class="stock-table" style="min-width:auto;">
                 <thead>
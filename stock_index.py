@@ -0,0 +1,200 @@
+"""
+股票代碼索引 - 代碼 → (中文名稱, 市場別) 的精簡 SQLite 檔
+由 twstock 的代碼表預先建好 (python stock_index.py)，執行期只以唯讀方式開啟查詢，
+不必在每個 worker 載入 twstock 與它的完整代碼表
+"""
+import bisect
+import logging
+import os
+import sqlite3
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+INDEX_PATH = os.environ.get("STOCK_INDEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "stock_index.db"))
+# 權證佔 twstock 代碼表九成以上，且不能以零股交易，不收進索引
+EXCLUDED_TYPE_KEYWORDS = ("權證",)
+# 單次 IN 查詢的代碼數上限 (SQLite 參數數量限制)
+LOOKUP_CHUNK_SIZE = 500
+
+# 搜尋回傳筆數的預設值與上限
+SEARCH_LIMIT = 10
+SEARCH_LIMIT_MAX = 50
+
+_conn = None
+_conn_lock = threading.Lock()
+# 搜尋用的記憶體索引，第一次搜尋時才由索引檔建立
+_search_index = None
+
+
+def build_index(path=INDEX_PATH):
+    """
+    以 twstock 的代碼表重建索引檔，先寫入暫存檔再整檔替換，執行中的查詢不受影響
+    回傳收錄的代碼數
+    """
+    import twstock
+
+    rows = sorted(
+        (code, info.name, info.market)
+        for code, info in twstock.codes.items()
+        if not any(keyword in (info.type or "") for keyword in EXCLUDED_TYPE_KEYWORDS)
+    )
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # 暫存檔名帶上 pid 與執行緒，多個 worker 同時重建也不會互相覆寫
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute("PRAGMA page_size=4096")
+        conn.execute("""
+            CREATE TABLE stock_code (
+                code TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                market TEXT NOT NULL
+            ) WITHOUT ROWID
+        """)
+        conn.executemany("INSERT INTO stock_code (code, name, market) VALUES (?, ?, ?)", rows)
+        conn.commit()
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+    _reset()
+    return len(rows)
+
+
+def _reset():
+    """關閉目前的唯讀連線，下次查詢時重新開啟 (索引檔重建後呼叫)"""
+    global _conn, _search_index
+    with _conn_lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+        _search_index = None
+
+
+def _get_conn():
+    """第一次查詢時才開啟索引檔；檔案不存在時嘗試現場建立一次"""
+    global _conn
+    if _conn is not None:
+        return _conn
+    if not os.path.exists(INDEX_PATH):
+        try:
+            count = build_index(INDEX_PATH)
+            logger.info(f"股票代碼索引不存在，已重新建立 ({count} 檔)")
+        except Exception as e:
+            logger.warning(f"股票代碼索引不存在且無法建立: {e}")
+            return None
+    with _conn_lock:
+        if _conn is None:
+            # immutable=1：執行期不會改寫這個檔案，省去檔案鎖；重建是整檔替換
+            _conn = sqlite3.connect(f"file:{INDEX_PATH}?mode=ro&immutable=1", uri=True, check_same_thread=False)
+        return _conn
+
+
+def lookup(stock_codes):
+    """批次查詢代碼，回傳 {stock_code: (name, market)}，索引中沒有的代碼不會出現在結果中"""
+    codes = list(dict.fromkeys(str(code).strip() for code in stock_codes if str(code).strip()))
+    conn = _get_conn()
+    if conn is None or not codes:
+        return {}
+    found = {}
+    with _conn_lock:
+        for i in range(0, len(codes), LOOKUP_CHUNK_SIZE):
+            chunk = codes[i:i + LOOKUP_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            for code, name, market in conn.execute(
+                f"SELECT code, name, market FROM stock_code WHERE code IN ({placeholders})", chunk
+            ):
+                found[code] = (name, market)
+    return found
+
+
+def get_stock_names(stock_codes):
+    """批次取得中文股票名稱，回傳 {stock_code: name}，查不到的為「未知」"""
+    codes = [str(code).strip() for code in stock_codes if str(code).strip()]
+    found = lookup(codes)
+    return {code: found[code][0] if code in found else "未知" for code in codes}
+
+
+def get_stock_name(stock_code):
+    """取得單一代碼的中文股票名稱，查不到時回傳「未知」"""
+    return get_stock_names([stock_code]).get(str(stock_code).strip(), "未知")
+
+
+def get_markets(stock_codes):
+    """批次取得代碼的市場別 (上市 / 上櫃 ...)，回傳 {stock_code: market}"""
+    return {code: market for code, (_, market) in lookup(stock_codes).items()}
+
+
+# ============ 代碼 / 名稱搜尋 ============
+
+def _grams(text):
+    """名稱的索引單位：單字與相鄰兩字 (中文名稱沒有分詞，以 bigram 支援任意子字串查詢)"""
+    return set(text) | {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def _build_search_index():
+    """
+    由索引檔建立搜尋用的記憶體結構：
+    codes 為排序好的代碼 (以 bisect 做前綴查詢)，grams 為 單字 / 兩字 → 列索引 的倒排表
+    """
+    conn = _get_conn()
+    if conn is None:
+        return {"codes": [], "rows": [], "names": [], "grams": {}}
+    with _conn_lock:
+        rows = conn.execute("SELECT code, name, market FROM stock_code ORDER BY code").fetchall()
+    grams = {}
+    for i, (_, name, _) in enumerate(rows):
+        for gram in _grams(name.casefold()):
+            grams.setdefault(gram, []).append(i)
+    return {
+        "codes": [code for code, _, _ in rows],
+        "rows": rows,
+        "names": [name.casefold() for _, name, _ in rows],
+        "grams": grams
+    }
+
+
+def _get_search_index():
+    global _search_index
+    index = _search_index
+    if index is None:
+        index = _search_index = _build_search_index()
+    return index
+
+
+def search(query, limit=SEARCH_LIMIT):
+    """
+    以代碼前綴或名稱子字串搜尋股票，不呼叫任何上游
+    排序：代碼完全相同 > 代碼前綴 > 名稱開頭 > 名稱包含，同級依代碼排序
+    回傳: [{"code", "name", "market"}, ...]，最多 limit 筆
+    """
+    query = str(query).strip().casefold()
+    if not query:
+        return []
+    index = _get_search_index()
+    codes, rows, names = index["codes"], index["rows"], index["names"]
+
+    ranked = {}
+    start = bisect.bisect_left(codes, query)
+    end = bisect.bisect_left(codes, query + "\uffff")
+    for i in range(start, min(end, start + limit)):
+        ranked[i] = 0 if codes[i] == query else 1
+
+    # 名稱：以查詢字串的每個 bigram (單字查詢則用該字) 取倒排表交集，再確認確實包含
+    grams = {query} if len(query) == 1 else {query[i:i + 2] for i in range(len(query) - 1)}
+    postings = sorted((index["grams"].get(gram, []) for gram in grams), key=len)
+    candidates = set(postings[0]).intersection(*postings[1:]) if postings else set()
+    for i in candidates:
+        if i not in ranked and query in names[i]:
+            ranked[i] = 2 if names[i].startswith(query) else 3
+
+    best = sorted(ranked, key=lambda i: (ranked[i], codes[i]))[:limit]
+    return [{"code": rows[i][0], "name": rows[i][1], "market": rows[i][2]} for i in best]
+
+
+if __name__ == "__main__":
+    target = sys.argv[1] if len(sys.argv) > 1 else INDEX_PATH
+    count = build_index(target)
+    print(f"股票代碼索引已建立：{target} ({count} 檔，{os.path.getsize(target) / 1024:.0f} KiB)")
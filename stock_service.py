@@ -1,52 +1,661 @@
 """
 股價服務 - 抓取台股即時股價與中文名稱
 """
+import itertools
 import logging
-import yfinance as yf
-import twstock
-
-# 抑制 yfinance 的警告訊息
-logging.getLogger("yfinance").setLevel(logging.CRITICAL)
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import stock_index
+import startup_profile
+from models import (
+    release_db, get_cached_quotes, save_quotes, claim_quote_refresh,
+    get_stock_suffixes, save_stock_suffixes,
+    get_history_targets, get_history_ranges, save_price_history
+)
 
 logger = logging.getLogger(__name__)
 
+# 上市 / 上櫃 的 Yahoo 代碼後綴
+SUFFIX_TWSE = ".TW"
+SUFFIX_TPEX = ".TWO"
+# 股票代碼索引的市場別對應的後綴
+MARKET_SUFFIXES = {"上市": SUFFIX_TWSE, "上櫃": SUFFIX_TPEX}
+
+# 報價快取：盤中的有效秒數；過期後仍可在 QUOTE_MAX_STALE 秒內先回舊值並背景刷新
+QUOTE_TTL = float(os.environ.get("QUOTE_TTL", 60))
+QUOTE_MAX_STALE = float(os.environ.get("QUOTE_MAX_STALE", 15 * 60))
+# 背景刷新的租約秒數，逾時未完成時其他 worker 可重新接手
+QUOTE_REFRESH_LEASE = 30
+
+# 台股交易時段 (台北時間，無日光節約)
+TW_TZ = timezone(timedelta(hours=8))
+MARKET_OPEN = (9, 0)
+MARKET_CLOSE = (13, 30)
+# 收盤後 Yahoo 需要一點時間才會給出正式收盤價
+MARKET_CLOSE_GRACE = timedelta(minutes=15)
+
+# 日線補抓時每次 yf.download 的最多代碼數
+HISTORY_CHUNK_SIZE = int(os.environ.get("HISTORY_CHUNK_SIZE", 50))
+HISTORY_COLUMNS = ("Open", "High", "Low", "Close", "Volume")
+
+# 互動式試算的平行抓價：執行緒數上限、每個批次請求的代碼數與整體等待期限 (秒)
+QUOTE_WORKERS = int(os.environ.get("QUOTE_WORKERS", 8))
+QUOTE_DEADLINE = float(os.environ.get("QUOTE_DEADLINE", 8))
+QUOTE_CHUNK_SIZE = int(os.environ.get("QUOTE_CHUNK_SIZE", 50))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# yfinance 模組，第一次向上游抓取時才載入 (見 _yfinance)
+_yf = None
+_yf_import_lock = threading.Lock()
+
+# 同一代碼的上游抓取合併 (single-flight)：
+# 進行中的抓取 {stock_code: {"event", "result", "priority", "started"}}，started 表示上游請求已送出
+QUOTE_COALESCE_TIMEOUT = 60
+_inflight = {}
+_inflight_lock = threading.Lock()
+# 目前執行緒負責抓取的 _inflight 項目，call_upstream 實際送出時標記為 started
+_fetch_context = threading.local()
+_stats = {
+    "cache_hits": 0,        # 快取有效直接回傳
+    "stale_hits": 0,        # 回傳舊值並背景刷新
+    "misses": 0,            # 快取沒有，需同步抓取
+    "upstream_fetches": 0,  # 實際送往上游的代碼數
+    "coalesced": 0,         # 搭上他人進行中抓取的代碼數
+}
+
+# 上游 (Yahoo) 請求排程：優先序數字越小越先送出
+PRIORITY_INTERACTIVE = 0   # 使用者正在等待的查詢 (/api/stock-info、/api/calculate)
+PRIORITY_BULK = 10         # 批次/背景更新
+# 令牌桶：每秒補充 UPSTREAM_RATE 個請求額度，最多累積 UPSTREAM_BURST 個
+UPSTREAM_RATE = float(os.environ.get("UPSTREAM_RATE", 2))
+UPSTREAM_BURST = float(os.environ.get("UPSTREAM_BURST", 5))
+UPSTREAM_CONCURRENCY = int(os.environ.get("UPSTREAM_CONCURRENCY", 2))
+# 暫時性錯誤的重試次數與指數退避的基準秒數
+UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", 2))
+UPSTREAM_BACKOFF = float(os.environ.get("UPSTREAM_BACKOFF", 1))
+# 斷路器：連續失敗 BREAKER_THRESHOLD 次後暫停送出 BREAKER_COOLDOWN 秒
+BREAKER_THRESHOLD = int(os.environ.get("UPSTREAM_BREAKER_THRESHOLD", 5))
+BREAKER_COOLDOWN = float(os.environ.get("UPSTREAM_BREAKER_COOLDOWN", 60))
+
+_upstream_queue = queue.PriorityQueue()
+_upstream_seq = itertools.count()
+_upstream_lock = threading.Lock()
+_upstream_started = False
+_bucket = {"tokens": UPSTREAM_BURST, "updated": time.monotonic()}
+_breaker = {"failures": 0, "open_until": 0.0}
+
+# yfinance 的錯誤摘要中代表上游暫時無法服務的關鍵字
+TRANSIENT_ERROR_MARKERS = ("Rate", "Too Many Requests", "Connection", "Timeout", "timed out", "curl")
+# yfinance 錯誤摘要中的一行："['2330.TW', '2317.TW']: 錯誤訊息"
+_SYMBOL_ERROR = re.compile(r"^\s*\[([^\]]*)\]:\s*(.*)", re.S)
+
+
+class UpstreamError(Exception):
+    """上游暫時性錯誤 (限流、連線失敗等)，會觸發重試與斷路器"""
+
+
+class UpstreamUnavailable(UpstreamError):
+    """斷路器開啟中，請求未送出"""
+
+
+class _ThreadErrorCapture(logging.Handler):
+    """
+    收集 yfinance 在呼叫端執行緒記錄的錯誤摘要
+    yf.download 不會拋出個別代碼的錯誤，只會在結束前以 logger.error 彙整
+    """
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self._messages = threading.local()
+
+    def start(self):
+        self._messages.items = []
+
+    def stop(self):
+        items = getattr(self._messages, "items", None) or []
+        self._messages.items = None
+        return items
+
+    def emit(self, record):
+        items = getattr(self._messages, "items", None)
+        if items is not None:
+            items.append(record.getMessage())
+
+
+# yfinance 的錯誤只交給擷取器判斷，不輸出到應用程式日誌
+_yf_errors = _ThreadErrorCapture()
+_yf_logger = logging.getLogger("yfinance")
+_yf_logger.setLevel(logging.ERROR)
+_yf_logger.propagate = False
+_yf_logger.addHandler(_yf_errors)
+
 
 def get_stock_name(stock_code):
-    """利用 twstock 取得中文股票名稱"""
+    """由股票代碼索引取得中文股票名稱，查不到時回傳「未知」"""
+    return stock_index.get_stock_name(stock_code)
+
+
+def get_stock_names(stock_codes):
+    """批次取得中文股票名稱，回傳 {stock_code: name}，查不到的為「未知」"""
+    return stock_index.get_stock_names(_normalize_codes(stock_codes))
+
+
+# ============ 上游請求排程 (令牌桶 + 優先佇列 + 重試 + 斷路器) ============
+
+def _take_token():
+    """取得一個請求額度，額度不足時等待補充"""
+    while True:
+        with _upstream_lock:
+            now = time.monotonic()
+            _bucket["tokens"] = min(UPSTREAM_BURST, _bucket["tokens"] + (now - _bucket["updated"]) * UPSTREAM_RATE)
+            _bucket["updated"] = now
+            if _bucket["tokens"] >= 1:
+                _bucket["tokens"] -= 1
+                return
+            delay = (1 - _bucket["tokens"]) / UPSTREAM_RATE
+        time.sleep(delay)
+
+
+def _breaker_is_open():
+    with _upstream_lock:
+        return time.monotonic() < _breaker["open_until"]
+
+
+def _record_upstream_result(ok):
+    """更新斷路器狀態；冷卻結束後的第一個請求失敗會立即再次開啟 (half-open)"""
+    with _upstream_lock:
+        if ok:
+            _breaker["failures"] = 0
+            return
+        _breaker["failures"] += 1
+        if _breaker["failures"] >= BREAKER_THRESHOLD:
+            _breaker["open_until"] = time.monotonic() + BREAKER_COOLDOWN
+            logger.warning(f"上游連續失敗 {_breaker['failures']} 次，暫停送出 {BREAKER_COOLDOWN:.0f} 秒")
+
+
+def _run_upstream(fn):
+    """在額度與斷路器的限制下執行上游呼叫，暫時性錯誤依指數退避重試"""
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        if _breaker_is_open():
+            raise UpstreamUnavailable("上游暫時停止服務 (斷路器開啟中)")
+        _take_token()
+        try:
+            result = fn()
+        except Exception as e:
+            _record_upstream_result(False)
+            if attempt >= UPSTREAM_RETRIES:
+                raise
+            delay = UPSTREAM_BACKOFF * (2 ** attempt)
+            logger.info(f"上游請求失敗 ({e})，{delay:.1f} 秒後重試")
+            time.sleep(delay)
+            continue
+        _record_upstream_result(True)
+        return result
+
+
+def _upstream_worker():
+    while True:
+        _, _, fn, future = _upstream_queue.get()
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            future.set_result(_run_upstream(fn))
+        except BaseException as e:
+            future.set_exception(e)
+
+
+def _ensure_upstream_workers():
+    global _upstream_started
+    with _upstream_lock:
+        if _upstream_started:
+            return
+        _upstream_started = True
+    for i in range(UPSTREAM_CONCURRENCY):
+        threading.Thread(target=_upstream_worker, name=f"upstream-{i}", daemon=True).start()
+
+
+def call_upstream(fn, priority=PRIORITY_BULK):
+    """
+    將上游呼叫排入優先佇列並等待結果
+    互動式請求 (PRIORITY_INTERACTIVE) 會排在批次更新之前送出；斷路器開啟時直接失敗
+    """
+    if _breaker_is_open():
+        raise UpstreamUnavailable("上游暫時停止服務 (斷路器開啟中)")
+    _ensure_upstream_workers()
+    task = fn
+    calls = getattr(_fetch_context, "calls", None)
+    if calls:
+        def task():
+            for call in calls:
+                call["started"] = True
+            return fn()
+    future = Future()
+    _upstream_queue.put((priority, next(_upstream_seq), task, future))
+    return future.result()
+
+
+def get_upstream_stats():
+    with _upstream_lock:
+        return {
+            "queue_depth": _upstream_queue.qsize(),
+            "tokens": round(_bucket["tokens"], 2),
+            "consecutive_failures": _breaker["failures"],
+            "breaker_open": time.monotonic() < _breaker["open_until"],
+        }
+
+
+def _yfinance():
+    """
+    第一次需要向上游抓價時才載入 yfinance (連同 pandas 約需數百毫秒與數十 MB)，
+    只讀資料庫的請求與剛啟動的 worker 不必負擔
+    """
+    global _yf
+    if _yf is None:
+        with _yf_import_lock:
+            if _yf is None:
+                started = time.perf_counter()
+                import yfinance
+                _yf = yfinance
+                startup_profile.report("載入 yfinance", started)
+    return _yf
+
+
+def _transient_symbols(errors):
+    """
+    從 yfinance 的錯誤摘要 (每行為 "['2330.TW', ...]: 錯誤訊息") 取出因限流或連線問題
+    而沒有抓到的代碼
+    """
+    failed = set()
+    for message in errors:
+        match = _SYMBOL_ERROR.match(message)
+        if match and any(marker in match.group(2) for marker in TRANSIENT_ERROR_MARKERS):
+            failed.update(re.findall(r"'([^']+)'", match.group(1)))
+    return failed
+
+
+def _yf_download(symbols, **kwargs):
+    """
+    呼叫 yf.download；若整批都沒有資料且錯誤摘要顯示為限流或連線問題，
+    拋出 UpstreamError 讓排程器重試 (查無此代碼不算失敗)
+    回傳: (data, 因暫時性錯誤沒有抓到的代碼集合)
+    """
+    yf = _yfinance()
+    _yf_errors.start()
     try:
-        stock_info = twstock.codes.get(str(stock_code))
-        if stock_info:
-            return stock_info.name
-    except Exception:
-        pass
-    return "未知"
+        data = yf.download(tickers=" ".join(symbols), progress=False, **kwargs)
+    finally:
+        errors = _yf_errors.stop()
+    transient = [e for e in errors if any(marker in e for marker in TRANSIENT_ERROR_MARKERS)]
+    if transient and (data is None or data.empty):
+        raise UpstreamError(transient[0])
+    return data, _transient_symbols(errors)
 
 
-def get_stock_price(stock_code):
+def _download_closes(symbols, priority=PRIORITY_BULK):
     """
-    抓取台股最新收盤價
-    先嘗試上市 (.TW)，再嘗試上櫃 (.TWO)
-    回傳: (price, success)
+    以單次 yf.download 批次抓取多個 Yahoo 代碼的最新收盤價
+    回傳: {symbol: price}，抓不到的代碼不會出現在結果中
     """
+    if not symbols:
+        return {}
     try:
-        # 先嘗試上市
-        ticker = f"{stock_code}.TW"
-        stock = yf.Ticker(ticker)
-        hist = stock.history(period="1d")
+        data, _ = call_upstream(
+            lambda: _yf_download(symbols, period="5d", group_by="ticker", auto_adjust=False, threads=True),
+            priority
+        )
+    except Exception as e:
+        logger.warning(f"批次抓取股價失敗 ({len(symbols)} 檔): {e}")
+        return {}
+
+    if data is None or data.empty:
+        return {}
+
+    closes = {}
+    multi = getattr(data.columns, "nlevels", 1) > 1
+    tickers_in_frame = set(data.columns.get_level_values(0)) if multi else set()
+    for symbol in symbols:
+        try:
+            if multi:
+                if symbol not in tickers_in_frame:
+                    continue
+                series = data[symbol]["Close"]
+            else:
+                # 舊版 yfinance 單一代碼時不會有 ticker 層
+                series = data["Close"]
+            # 多檔合併後的日期索引可能含有其他代碼的交易日，取最後一筆有效收盤價
+            series = series.dropna()
+            if series.empty:
+                continue
+            closes[symbol] = float(series.iloc[-1])
+        except Exception as e:
+            logger.warning(f"解析 {symbol} 股價失敗: {e}")
+    return closes
+
+
+def _normalize_codes(stock_codes):
+    """去除空白與重複的代碼，保留原本順序"""
+    codes = []
+    seen = set()
+    for code in stock_codes:
+        code = str(code).strip()
+        if code and code not in seen:
+            seen.add(code)
+            codes.append(code)
+    return codes
+
+
+def _session_bounds(day):
+    """回傳某日 (台北時間) 的開盤與收盤時間"""
+    open_at = day.replace(hour=MARKET_OPEN[0], minute=MARKET_OPEN[1], second=0, microsecond=0)
+    close_at = day.replace(hour=MARKET_CLOSE[0], minute=MARKET_CLOSE[1], second=0, microsecond=0)
+    return open_at, close_at
+
+
+def _next_session_open(moment):
+    """回傳 moment 之後的下一個開盤時間 (僅排除週末，不含國定假日)"""
+    day = moment
+    while True:
+        open_at, _ = _session_bounds(day)
+        if day.weekday() < 5 and open_at > moment:
+            return open_at
+        day = (day + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def is_market_open(now=None):
+    """目前是否在台股交易時段內"""
+    moment = datetime.fromtimestamp(now if now is not None else time.time(), TW_TZ)
+    if moment.weekday() >= 5:
+        return False
+    open_at, close_at = _session_bounds(moment)
+    return open_at <= moment <= close_at
+
+
+def quote_expires_at(fetched_at):
+    """
+    計算一筆報價的有效期限 (epoch 秒)
+    盤中抓到的報價只有 QUOTE_TTL 秒；收盤後抓到的收盤價可一直用到下一次開盤
+    """
+    moment = datetime.fromtimestamp(fetched_at, TW_TZ)
+    open_at, close_at = _session_bounds(moment)
+    if moment.weekday() < 5 and open_at <= moment < close_at + MARKET_CLOSE_GRACE:
+        return min(fetched_at + QUOTE_TTL, (close_at + MARKET_CLOSE_GRACE).timestamp())
+    return _next_session_open(moment).timestamp()
+
+
+def _refresh_quotes_async(codes):
+    """搶到刷新權的代碼交給背景執行緒重抓，其餘代碼由其他請求或 worker 負責"""
+    claimed = claim_quote_refresh(codes, time.time(), QUOTE_REFRESH_LEASE)
+    if not claimed:
+        return
+
+    def run():
+        try:
+            _fetch_and_store(claimed)
+        except Exception as e:
+            logger.warning(f"背景刷新報價失敗: {e}")
+        finally:
+            release_db()
+
+    threading.Thread(target=run, name="quote-refresh", daemon=True).start()
+
+
+def _claim_inflight(codes, priority):
+    """
+    登記要向上游抓取的代碼，回傳 (lead: 由自己抓取的 {code: call}, follow: 等待他人結果的 {code: call})
+    已有其他執行緒正在抓取的代碼不重複送出；但對方的優先序較低且還在佇列中尚未送出時，
+    改由自己以較高的優先序另外抓取，互動式查詢不會被排在批次更新之後
+    """
+    lead = {}
+    follow = {}
+    with _inflight_lock:
+        for code in codes:
+            call = _inflight.get(code)
+            if call and (call["priority"] <= priority or call["started"]):
+                follow[code] = call
+            else:
+                call = {"event": threading.Event(), "result": (0.0, False), "priority": priority, "started": False}
+                _inflight[code] = call
+                lead[code] = call
+        _stats["upstream_fetches"] += len(lead)
+        _stats["coalesced"] += len(follow)
+    return lead, follow
+
+
+def _publish_results(lead, found):
+    """把抓到的報價寫入快取並喚醒等待這些代碼的呼叫端 (已公布過的代碼略過)"""
+    found = {code: result for code, result in found.items() if not lead[code]["event"].is_set()}
+    save_quotes({code: price for code, (price, success) in found.items() if success}, time.time())
+    with _inflight_lock:
+        for code, result in found.items():
+            call = lead[code]
+            # 可能已被較高優先序的抓取取代，只移除自己登記的項目
+            if _inflight.get(code) is call:
+                del _inflight[code]
+            call["result"] = result
+            call["event"].set()
 
-        # 上櫃
-        if hist.empty:
-            ticker = f"{stock_code}.TWO"
-            stock = yf.Ticker(ticker)
-            hist = stock.history(period="1d")
 
-        if hist.empty:
-            return 0.0, False
+def _fetch_lead(lead, priority):
+    """
+    抓取 _claim_inflight 分配給自己的代碼並寫入快取
+    第一輪就抓到的代碼立即公布，不必等另一市場的重試；結束時 (含失敗) 喚醒所有等待的呼叫端
+    """
+    _fetch_context.calls = list(lead.values())
+    try:
+        _publish_results(lead, _fetch_stock_prices(
+            list(lead), priority, on_found=lambda found: _publish_results(lead, found)
+        ))
+    finally:
+        _fetch_context.calls = None
+        _publish_results(lead, {code: (0.0, False) for code in lead})
+    return {code: call["result"] for code, call in lead.items()}
 
-        return float(hist['Close'].iloc[-1]), True
+
+def _fetch_lead_task(lead, priority):
+    try:
+        _fetch_lead(lead, priority)
     except Exception as e:
-        logger.warning(f"抓取 {stock_code} 股價失敗: {e}")
-        return 0.0, False
+        logger.warning(f"抓取 {', '.join(lead)} 股價失敗: {e}")
+    finally:
+        release_db()
+
+
+def _fetch_and_store(codes, priority=PRIORITY_BULK):
+    """
+    向上游抓取報價並寫入快取
+    已有其他執行緒正在抓取的代碼不重複送出，等待該次抓取完成後共用結果 (見 _claim_inflight)
+    """
+    lead, follow = _claim_inflight(codes, priority)
+    results = {}
+    if lead:
+        results.update(_fetch_lead(lead, priority))
+    for code, call in follow.items():
+        call["event"].wait(QUOTE_COALESCE_TIMEOUT)
+        results[code] = call["result"]
+    return results
+
+
+def get_quote_stats():
+    """報價快取命中與合併抓取的統計 (本 worker 啟動後累計)"""
+    with _inflight_lock:
+        stats = dict(_stats)
+        stats["inflight"] = len(_inflight)
+    stats["upstream"] = get_upstream_stats()
+    stats["pid"] = os.getpid()
+    return stats
+
+
+def get_stock_prices(stock_codes, priority=PRIORITY_BULK):
+    """
+    批次取得多檔台股最新收盤價 (經過 SQLite 報價快取)
+    有效的快取直接回傳；過期但未超過 QUOTE_MAX_STALE 的先回舊值並在背景刷新；
+    其餘代碼才會同步向 Yahoo 抓取
+    回傳: {stock_code: (price, success)}
+    """
+    codes = _normalize_codes(stock_codes)
+    results, stale, missing = _read_cached_quotes(codes)
+    if stale:
+        _refresh_quotes_async(stale)
+    if missing:
+        results.update(_fetch_and_store(missing, priority))
+
+    return {code: results[code] for code in codes}
+
+
+def _read_cached_quotes(codes):
+    """
+    從報價快取讀出可直接回傳的報價
+    回傳: (results: {code: (price, True)}, stale: 已過期需背景刷新的代碼, missing: 需同步抓取的代碼)
+    """
+    results = {}
+    now = time.time()
+    stale = []
+    missing = []
+    for code, quote in get_cached_quotes(codes).items():
+        expires_at = quote_expires_at(quote["fetched_at"])
+        if now <= expires_at:
+            results[code] = (quote["price"], True)
+        elif now - expires_at <= QUOTE_MAX_STALE:
+            results[code] = (quote["price"], True)
+            stale.append(code)
+    for code in codes:
+        if code not in results:
+            missing.append(code)
+    with _inflight_lock:
+        _stats["cache_hits"] += len(results) - len(stale)
+        _stats["stale_hits"] += len(stale)
+        _stats["misses"] += len(missing)
+    return results, stale, missing
+
+
+def _other_suffix(suffix):
+    return SUFFIX_TPEX if suffix == SUFFIX_TWSE else SUFFIX_TWSE
+
+
+def resolve_suffixes(stock_codes):
+    """
+    查詢代碼所屬市場的 Yahoo 後綴
+    先查已儲存的後綴，沒有的再用股票代碼索引的市場別補齊並寫回資料庫
+    回傳: {stock_code: suffix}，兩者都查不到的代碼不會出現在結果中
+    """
+    codes = _normalize_codes(stock_codes)
+    suffixes = get_stock_suffixes(codes)
+
+    markets = stock_index.get_markets([code for code in codes if code not in suffixes])
+    learned = {}
+    for code, market in markets.items():
+        suffix = MARKET_SUFFIXES.get(market)
+        if suffix:
+            learned[code] = suffix
+    if learned:
+        save_stock_suffixes(learned, "twstock")
+        suffixes.update(learned)
+    return suffixes
+
+
+def _fetch_stock_prices(stock_codes, priority=PRIORITY_BULK, on_found=None):
+    """
+    直接向 Yahoo 批次抓取多檔台股最新收盤價
+    已知市場的代碼直接用對應後綴；未知的先當上市 (.TW)，與已知代碼合併成一次請求。
+    第一輪沒抓到的再以一次請求改查另一個市場，成功後把後綴記入索引
+    on_found: 第一輪結束時以 {stock_code: (price, True)} 呼叫，讓呼叫端先取用已抓到的報價
+    回傳: {stock_code: (price, success)}
+    """
+    codes = _normalize_codes(stock_codes)
+    results = {code: (0.0, False) for code in codes}
+    if not codes:
+        return results
+
+    known = resolve_suffixes(codes)
+    first = {code: known.get(code, SUFFIX_TWSE) for code in codes}
+    closes = _download_closes([f"{code}{suffix}" for code, suffix in first.items()], priority)
+    learned = {}
+    retry = {}
+    for code, suffix in first.items():
+        price = closes.get(f"{code}{suffix}")
+        if price is not None:
+            results[code] = (price, True)
+            if code not in known:
+                learned[code] = suffix
+        else:
+            # 未知代碼改查上櫃；已知代碼也再試另一市場 (可能已轉上市/上櫃)
+            retry[code] = _other_suffix(suffix)
+
+    if on_found and retry:
+        on_found({code: result for code, result in results.items() if result[1]})
+    if retry:
+        closes = _download_closes([f"{code}{suffix}" for code, suffix in retry.items()], priority)
+        for code, suffix in retry.items():
+            price = closes.get(f"{code}{suffix}")
+            if price is not None:
+                results[code] = (price, True)
+                learned[code] = suffix
+
+    if learned:
+        save_stock_suffixes(learned, "fetch")
+
+    return results
+
+
+def get_stock_price(stock_code, priority=PRIORITY_INTERACTIVE):
+    """
+    抓取台股最新收盤價 (預設為互動式優先序)
+    依市場索引直接使用 .TW / .TWO，未知代碼才依序嘗試上市、上櫃
+    回傳: (price, success)
+    """
+    code = str(stock_code).strip()
+    return get_stock_prices([code], priority).get(code, (0.0, False))
+
+
+def _get_executor():
+    """共用的有界執行緒池，第一次使用時才建立"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=QUOTE_WORKERS, thread_name_prefix="quote")
+        return _executor
+
+
+def get_stock_prices_within(stock_codes, deadline=QUOTE_DEADLINE):
+    """
+    取得多檔股價，最多等待 deadline 秒
+    快取中的報價 (含過期待刷新的) 直接回傳；其餘以批次請求抓取 (每 QUOTE_CHUNK_SIZE 檔一次
+    yf.download，多個批次在執行緒池平行執行)，並逐檔等待抓取結果
+    只有逾時仍沒有結果的代碼回傳 (0.0, False)，不會拖住整個回應 (背景抓取完成後仍會寫入快取)
+    回傳: ({stock_code: (price, success)}, 實際等待秒數, 逾時的代碼清單)
+    """
+    codes = _normalize_codes(stock_codes)
+    started = time.monotonic()
+    results, stale, missing = _read_cached_quotes(codes)
+    if stale:
+        _refresh_quotes_async(stale)
+
+    lead, follow = _claim_inflight(missing, PRIORITY_INTERACTIVE)
+    executor = _get_executor()
+    lead_items = list(lead.items())
+    for i in range(0, len(lead_items), QUOTE_CHUNK_SIZE):
+        executor.submit(_fetch_lead_task, dict(lead_items[i:i + QUOTE_CHUNK_SIZE]), PRIORITY_INTERACTIVE)
+
+    calls = {**lead, **follow}
+    timed_out = []
+    for code in missing:
+        remaining = max(0.0, deadline - (time.monotonic() - started))
+        if calls[code]["event"].wait(remaining):
+            results[code] = calls[code]["result"]
+        else:
+            timed_out.append(code)
+            results[code] = (0.0, False)
+
+    if timed_out:
+        logger.warning(f"抓價逾時 ({deadline:.1f}s): {', '.join(timed_out)}")
+    return {code: results[code] for code in codes}, time.monotonic() - started, timed_out
 
 
 def get_stock_info(stock_code):
@@ -63,3 +672,160 @@ def get_stock_info(stock_code):
         "success": success
     }
 
+
+# ============ 日線歷史 ============
+
+def _shift_date(date_str, days):
+    return (datetime.strptime(date_str, "%Y-%m-%d") + timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+def last_closed_session_date(now=None):
+    """最近一個已收盤 (含寬限時間) 交易日的日期，更晚的日線可能尚未定案"""
+    moment = datetime.fromtimestamp(now if now is not None else time.time(), TW_TZ)
+    day = moment
+    while True:
+        _, close_at = _session_bounds(day)
+        if day.weekday() < 5 and close_at + MARKET_CLOSE_GRACE <= moment:
+            return day.strftime("%Y-%m-%d")
+        day = day - timedelta(days=1)
+
+
+def _download_history(symbols, start, end, priority=PRIORITY_BULK):
+    """
+    以單次 yf.download 批次抓取多個 Yahoo 代碼在 [start, end] 的日線
+    回傳: ({symbol: [(date, open, high, low, close, volume)]}, 因暫時性錯誤沒有抓到的代碼集合)，
+    沒有資料的代碼不會出現在前者；整批上游失敗時回傳 None
+    """
+    try:
+        data, failed = call_upstream(
+            lambda: _yf_download(
+                symbols, start=start, end=_shift_date(end, 1), interval="1d",
+                group_by="ticker", auto_adjust=False, threads=True
+            ),
+            priority
+        )
+    except Exception as e:
+        logger.warning(f"批次抓取日線失敗 ({len(symbols)} 檔 {start}~{end}): {e}")
+        return None
+
+    bars = {}
+    if data is None or data.empty:
+        return bars, failed
+    multi = getattr(data.columns, "nlevels", 1) > 1
+    tickers_in_frame = set(data.columns.get_level_values(0)) if multi else set()
+    for symbol in symbols:
+        try:
+            if multi:
+                if symbol not in tickers_in_frame:
+                    continue
+                frame = data[symbol]
+            else:
+                frame = data
+            frame = frame.dropna(subset=["Close"])
+            if frame.empty:
+                continue
+            dates = frame.index.strftime("%Y-%m-%d")
+            columns = [frame[col].tolist() for col in HISTORY_COLUMNS]
+            bars[symbol] = [
+                (date, o, h, l, c, None if v != v else int(v))
+                for date, o, h, l, c, v in zip(dates, *columns)
+            ]
+        except Exception as e:
+            logger.warning(f"解析 {symbol} 日線失敗: {e}")
+    return bars, failed
+
+
+def _backfill_chunk(codes, start, end, known, priority):
+    """
+    抓取一組代碼在同一日期區間的日線並寫入，未知市場的代碼沒抓到時改查上櫃
+    上游有回應且該代碼沒有暫時性錯誤才記為已查詢 (區間內沒有交易日也一樣)；
+    因限流或連線問題被略過的代碼列為失敗，下次補抓時重試，回傳 (寫入筆數, 失敗代碼)
+    """
+    first = {code: known.get(code, SUFFIX_TWSE) for code in codes}
+    fetched = _download_history([f"{code}{suffix}" for code, suffix in first.items()], start, end, priority)
+    if fetched is None:
+        return 0, list(codes)
+    fetched, transient = fetched
+
+    rows = []
+    covered = {}
+    learned = {}
+    retry = {}
+    failed = []
+    for code, suffix in first.items():
+        if f"{code}{suffix}" in transient:
+            failed.append(code)
+            continue
+        bars = fetched.get(f"{code}{suffix}")
+        if bars:
+            rows += [(code,) + bar for bar in bars]
+            if code not in known:
+                learned[code] = suffix
+        elif code not in known:
+            retry[code] = _other_suffix(suffix)
+            continue
+        covered[code] = (start, end)
+
+    if retry:
+        fetched = _download_history([f"{code}{suffix}" for code, suffix in retry.items()], start, end, priority)
+        fetched, transient = fetched if fetched is not None else (None, set())
+        for code, suffix in retry.items():
+            if fetched is None or f"{code}{suffix}" in transient:
+                failed.append(code)
+                continue
+            bars = fetched.get(f"{code}{suffix}")
+            if bars:
+                rows += [(code,) + bar for bar in bars]
+                learned[code] = suffix
+            covered[code] = (start, end)
+
+    if learned:
+        save_stock_suffixes(learned, "fetch")
+    save_price_history(rows, covered)
+    return len(rows), failed
+
+
+def backfill_price_history(targets=None, now=None, priority=PRIORITY_BULK):
+    """
+    補齊日線歷史：每個代碼只抓已查詢區間 (price_history_range) 之外缺少的日期，
+    最晚到最近一個已收盤的交易日；需要相同日期區間的代碼合併成一次 yf.download
+    (每天的增量補抓中所有代碼的缺口相同，通常只需一次請求)
+    targets: {stock_code: (start_date, end_date 或 None)}，預設為所有持有過的代碼
+    回傳: {"bars": 寫入筆數, "windows": 日期區間數, "failed": [失敗代碼]}
+    """
+    last_day = last_closed_session_date(now)
+    if targets is None:
+        targets = get_history_targets()
+    covered = get_history_ranges(targets.keys())
+
+    windows = {}
+    for code, (start, end) in targets.items():
+        end = min(end or last_day, last_day)
+        if start > end:
+            continue
+        have = covered.get(code)
+        if have is None:
+            missing = [(start, end)]
+        else:
+            missing = []
+            if start < have[0]:
+                missing.append((start, _shift_date(have[0], -1)))
+            if end > have[1]:
+                missing.append((_shift_date(have[1], 1), end))
+        for window in missing:
+            windows.setdefault(window, []).append(code)
+
+    if not windows:
+        return {"bars": 0, "windows": 0, "failed": []}
+
+    known = resolve_suffixes({code for codes in windows.values() for code in codes})
+    total = 0
+    failed = []
+    for (start, end), codes in sorted(windows.items()):
+        for i in range(0, len(codes), HISTORY_CHUNK_SIZE):
+            written, chunk_failed = _backfill_chunk(codes[i:i + HISTORY_CHUNK_SIZE], start, end, known, priority)
+            total += written
+            failed += chunk_failed
+
+    logger.info(f"日線補抓完成：{len(windows)} 個區間，寫入 {total} 筆，{len(failed)} 檔失敗")
+    return {"bars": total, "windows": len(windows), "failed": sorted(set(failed))}